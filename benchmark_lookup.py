@@ -0,0 +1,89 @@
+"""
+Benchmark the per-batch cost of looking up the feature datasets of a batch,
+by video name (int(videos[idx]), then f[str(video_id)] and its storage offset,
+in every feature file) versus by the integer row index that the DataLoader
+builds once per process (index_feat_h5)
+"""
+
+import time
+import argparse
+import numpy as np
+
+import logging
+
+from dataloader import DataLoader
+
+logger = logging.getLogger(__name__)
+
+
+def lookup_by_name(loader, batch_ix):
+    for f in loader.get_feat_h5():
+        video_ids = [int(loader.videos[idx]) for idx in batch_ix]
+        dsets = [f[str(video_id)] for video_id in video_ids]
+        offsets = [ds.id.get_offset() for ds in dsets]
+        order = sorted(
+            range(len(dsets)),
+            key=lambda ii: (offsets[ii] is None, offsets[ii] or 0, ii))
+
+
+def lookup_by_index(loader, batch_ix):
+    loader.get_feat_h5()
+    for jj in range(loader.get_num_feats()):
+        dsets = [loader.feat_dsets[jj][idx] for idx in batch_ix]
+        order = np.argsort(loader.feat_offsets[jj][batch_ix], kind='stable')
+
+
+def time_per_batch(fn, loader, batches):
+    start = time.time()
+    for batch_ix in batches:
+        fn(loader, batch_ix)
+    return (time.time() - start) / len(batches)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s:%(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('label_h5', type=str, help='_sequencelabel.h5 file')
+    parser.add_argument(
+        'feat_h5', type=str, nargs='+', help='feature h5 files')
+    parser.add_argument(
+        '--batch_sizes',
+        type=int,
+        nargs='+',
+        default=[64, 128, 256, 512],
+        help='batch sizes to benchmark')
+    parser.add_argument(
+        '--num_batches',
+        type=int,
+        default=50,
+        help='number of random batches per batch size')
+
+    args = parser.parse_args()
+    logger.info('Input parameters: %s', args)
+
+    loader = DataLoader({
+        'label_h5': args.label_h5,
+        'feat_h5': args.feat_h5,
+        'mode': 'test'
+    })
+
+    start = time.time()
+    loader.get_feat_h5()
+    logger.info('Building the index of %d videos x %d files: %.3f s',
+                loader.get_num_videos(), loader.get_num_feats(),
+                time.time() - start)
+
+    for batch_size in args.batch_sizes:
+        batches = [
+            np.random.randint(loader.get_num_videos(), size=batch_size)
+            for _ in range(args.num_batches)
+        ]
+        t_name = time_per_batch(lookup_by_name, loader, batches)
+        t_index = time_per_batch(lookup_by_index, loader, batches)
+        logger.info(
+            'batch_size %d: by name %.3f ms/batch, by index %.3f ms/batch (%.1fx)',
+            batch_size, t_name * 1000, t_index * 1000, t_name / t_index)
+
+    loader.close()
@@ -31,6 +31,7 @@ import logging
 from datetime import datetime
 
 import utils
+from dataloader import bcmrscores_file
 logger = logging.getLogger(__name__)
 import pickle
 
@@ -47,6 +48,10 @@ if __name__ == "__main__":
         type=int,
         default=20,
         help='Number of caption per image/video')
+    parser.add_argument(
+        '--output_dir',
+        type=str,
+        help='Also write one .npy file per metric and the video index (videos.json) to this directory, to be memory-mapped at training time')
     parser.add_argument(
         '--remove_in_ref',
         default=False,
@@ -107,4 +112,13 @@ if __name__ == "__main__":
         open(args.output_pkl, 'wb'),
         protocol=pickle.HIGHEST_PROTOCOL)
 
+    if args.output_dir:
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+        for method in gt_scores:
+            np.save(bcmrscores_file(args.output_dir, method), gt_scores[method])
+        json.dump([str(v) for v in videos],
+                  open(bcmrscores_file(args.output_dir, 'videos'), 'w'))
+        logger.info('Wrote to %s', args.output_dir)
+
     logger.info('Time: %s', datetime.now() - start)
@@ -65,6 +65,20 @@ def encode_captions(videos, max_length, wtoi):
     return L, label_start_ix, label_end_ix, label_length, label_to_video
 
 
+def select_tokens(videos, wtoi):
+    """
+    add <bos> and <eos> to the processed tokens of each caption, and replace
+    the words that are not in the vocab by <unk>
+    """
+    for v in videos:
+        v['final_captions'] = []
+        for txt in v['processed_tokens']:
+            caption = [__BOS_TOKEN]
+            caption += [w if w in wtoi else __UNK_TOKEN for w in txt]
+            caption += [__EOS_TOKEN]
+            v['final_captions'].append(caption)
+
+
 def main(vocab_json, captions_json, output_h5, max_length):
 
     # create the vocab
@@ -76,13 +90,7 @@ def main(vocab_json, captions_json, output_h5, max_length):
     videos = json.load(open(captions_json))
 
     logger.info('Select tokens in the vocab only')
-    for v in videos:
-        v['final_captions'] = []
-        for txt in v['processed_tokens']:
-            caption = [__BOS_TOKEN]
-            caption += [w if w in wtoi else __UNK_TOKEN for w in txt]
-            caption += [__EOS_TOKEN]
-            v['final_captions'].append(caption)
+    select_tokens(videos, wtoi)
 
     with h5py.File(output_h5, 'w') as of:
         if len(videos[0]['captions']) > 0:
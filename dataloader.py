@@ -6,6 +6,14 @@ import numpy as np
 import random
 import time
 import pickle
+import queue
+import threading
+import atexit
+import fcntl
+import hashlib
+from collections import OrderedDict
+
+from build_vocab import __UNK_TOKEN as UNK_TOKEN
 
 import logging
 from datetime import datetime
@@ -27,141 +35,405 @@ class DataLoader():
         self.mode = opt.get('mode', 'train')
         self.cocofmt_file = opt.get('cocofmt_file', None)
         self.bcmrscores_pkl = opt.get('bcmrscores_pkl', None)
+        self.prefetch = opt.get('prefetch', 0)
+        self.bulk_read = opt.get('bulk_read', 1)
+        self.num_buffers = opt.get('num_buffers', 0)
+        self.share_buffers = opt.get('share_buffers', 0)
+        self.feat_cache_mb = opt.get('feat_cache_mb', 0)
+        self.shm_cache = opt.get('shm_cache', 0)
+        self.rank = opt.get('rank', 0)
+        self.world_size = opt.get('world_size', 1)
+        self.seed = opt.get('seed', 123)
+        # index of the dataset in a MixtureLoader
+        self.source = opt.get('source', 0)
+        self.length_bucketing = opt.get('length_bucketing', 0)
+        self.exact_final_batch = opt.get('exact_final_batch', 0)
+        self.block_size = opt.get('block_size', 0)
+        self.block_window = opt.get('block_window', 4)
+        self.prefetcher = None
+        # RNG states after the last batch returned with prefetching
+        self.rng_state = None
 
-        # open the hdf5 info file
+        # open the hdf5 info file, everything is read at once so that
+        # no handle is kept
         logger.info('DataLoader loading h5 file: %s', opt['label_h5'])
-        self.label_h5 = h5py.File(opt['label_h5'], 'r')
-        self.vocab = [i.decode() for i in self.label_h5['vocab']]
-        self.videos = [i.decode() for i in self.label_h5['videos']]
+        if is_feature_store(opt['label_h5']):
+            # appendable store, see ingest_videos.py
+            self.label_store = FeatureStore(opt['label_h5'])
+            label_h5 = self.label_store.get_labels()
+        else:
+            self.label_store = None
+            label_h5 = h5py.File(opt['label_h5'], 'r')
+        self.vocab = [i.decode() for i in label_h5['vocab']]
+        self.videos = [i.decode() for i in label_h5['videos']]
+        self.video_ids = [int(v) for v in self.videos]
 
         self.ix_to_word = {i: w for i, w in enumerate(self.vocab)}
         self.num_videos = len(self.videos)
         self.index = list(range(self.num_videos))
+        if self.world_size > 1:
+            assert 0 <= self.rank < self.world_size
 
         # load the json file which contains additional information about the
         # dataset
         feat_h5_files = opt['feat_h5']
         logger.info('DataLoader loading h5 files: %s', feat_h5_files)
-        self.feat_h5 = []
+        self.feat_rows = []
         self.feat_dims = []
+        # per-dimension scales of int8 features, see quantize_features.py
+        self.feat_scales = []
+        # features of h5 files held in /dev/shm for all jobs of the node
+        self.shm_segments = []
+        # stores of the features appended by ingest_videos.py
+        self.feat_stores = []
+        # first chunk of each row of ragged packed features, None if the
+        # videos have num_chunks chunks
+        self.chunk_offsets = []
         for ii, feat_h5_file in enumerate(feat_h5_files):
-            self.feat_h5.append(h5py.File(feat_h5_files[ii], 'r'))
-            self.feat_dims.append(self.feat_h5[ii][self.videos[0]].shape[0])
+            self.feat_stores.append(self.get_feat_store(feat_h5_file))
+            self.chunk_offsets.append(None)
+            if feat_h5_file.endswith('.npy') or self.feat_stores[ii] is not None:
+                # packed features, see pack_features.py
+                feats, rows, self.chunk_offsets[ii] = self.open_packed_feats(
+                    feat_h5_file, self.feat_stores[ii])
+                self.feat_rows.append(rows)
+                self.feat_dims.append(feats.shape[-1])
+                scale_file = packed_scale_file(feat_h5_file)
+                self.feat_scales.append(
+                    np.load(scale_file) if os.path.exists(scale_file) else None)
+                self.shm_segments.append(None)
+            elif self.shm_cache == 1:
+                segment = SharedFeatureSegment(feat_h5_file, self.videos)
+                self.feat_rows.append(np.arange(self.num_videos))
+                self.feat_dims.append(segment.feats.shape[-1])
+                self.feat_scales.append(segment.scale)
+                self.shm_segments.append(segment)
+            else:
+                with h5py.File(feat_h5_file, 'r') as f:
+                    self.feat_rows.append(None)
+                    self.feat_dims.append(f[self.videos[0]].shape[-1])
+                    self.feat_scales.append(f.attrs.get('scale'))
+                self.shm_segments.append(None)
 
+            if self.feat_scales[ii] is not None:
+                logger.info('Dequantizing int8 features of %s', feat_h5_file)
+
+        self.feat_h5_files = feat_h5_files
         self.num_feats = len(feat_h5_files)
 
+        # raw data chunk cache of each h5 feature file
+        self.chunk_caches = [
+            chunk_cache_kwargs(opt, ii) for ii in range(self.num_feats)
+        ]
+        # bytes, read calls and seconds spent reading each feature file
+        self.io_bytes = np.zeros(self.num_feats, dtype=np.int64)
+        self.io_calls = np.zeros(self.num_feats, dtype=np.int64)
+        self.io_time = np.zeros(self.num_feats)
+
+        if self.block_size > 0:
+            assert self.length_bucketing == 0, \
+                'block shuffle and length bucketing cannot be used together'
+            self.storage_rank = self.get_storage_rank()
+            self.shuffle_randomness = None
+
+        # feature files are opened on first use by each process, as h5py
+        # handles cannot be shared across fork (see get_feat_h5)
+        self.feat_h5 = None
+        self.feat_h5_pid = None
+
+        # RNG of the caption sampling, see init_worker
+        self.init_worker(0)
+        # RNG of the epoch shuffles, owned by the loader rather than global so
+        # that the prefetching threads of a MixtureLoader do not race on it;
+        # the trailing 1 keeps it apart from the caption sampling streams
+        self.shuffle_rng = np.random.RandomState(
+            [self.seed, self.rank, self.source, 1])
+
+        # cache of the features read from h5 files, 0 = no cache
+        self.feat_cache = FeatureCache(
+            self.feat_cache_mb * 2**20) if self.feat_cache_mb > 0 else None
+
         # load in the sequence data
-        if 'labels' in self.label_h5.keys():
-            self.seq_length = self.label_h5['labels'].shape[1]
+        if 'labels' in label_h5.keys():
+            self.seq_length = label_h5['labels'].shape[1]
             logger.info('max sequence length in data is: %d', self.seq_length)
+            self.mask_positions = torch.arange(self.seq_length).unsqueeze(0)
 
-            # load the pointers in full to RAM (should be small enough)
-            self.label_start_ix = self.label_h5['label_start_ix']
-            self.label_end_ix = self.label_h5['label_end_ix']
+            # load the labels and pointers in full to RAM (should be small enough)
+            self.labels = torch.from_numpy(
+                label_h5['labels'][:].astype(np.int64))
+            self.label_start_ix = label_h5['label_start_ix'][:]
+            self.label_end_ix = label_h5['label_end_ix'][:]
             assert (self.label_start_ix.shape[0] == self.label_end_ix.shape[0])
             self.has_label = True
+
+            # length of the longest caption (with <bos> and <eos>) of each video
+            if 'label_length' in label_h5.keys():
+                label_length = label_h5['label_length'][:]
+            else:
+                label_length = (self.labels != 0).sum(1).numpy() + 1
+            self.video_lengths = np.maximum.reduceat(label_length,
+                                                     self.label_start_ix)
         else:
             self.has_label = False
+        if self.label_store is None:
+            label_h5.close()
+
+        # encode the labels with a vocabulary shared with other datasets
+        vocab = opt.get('vocab', None)
+        if vocab is not None and vocab != self.vocab:
+            self.remap_vocab(vocab)
+
+        # number of RNN steps needed by the batches loaded so far
+        self.num_steps = 0
+        self.num_label_batches = 0
 
         if self.bcmrscores_pkl is not None:
             eval_metric = opt.get('eval_metric', 'CIDEr')
             logger.info('Loading: %s, with metric: %s', self.bcmrscores_pkl,
                         eval_metric)
-            self.bcmrscores = pickle.load(open(self.bcmrscores_pkl, 'rb'))
-            if eval_metric == 'CIDEr' and eval_metric not in self.bcmrscores:
-                eval_metric = 'cider'
-            self.bcmrscores = self.bcmrscores[eval_metric]
+            if os.path.isdir(self.bcmrscores_pkl):
+                # one memory-mapped file per metric, see compute_scores.py
+                if eval_metric == 'CIDEr' and not os.path.exists(
+                        bcmrscores_file(self.bcmrscores_pkl, eval_metric)):
+                    eval_metric = 'cider'
+                self.bcmrscores = np.load(
+                    bcmrscores_file(self.bcmrscores_pkl, eval_metric),
+                    mmap_mode='r')
+                score_videos = json.load(
+                    open(bcmrscores_file(self.bcmrscores_pkl, 'videos')))
+                assert self.bcmrscores.shape[0] == len(score_videos)
+                self.bcmrscores_rows = self.map_rows(score_videos,
+                                                     self.bcmrscores_pkl)
+            else:
+                self.bcmrscores = pickle.load(open(self.bcmrscores_pkl, 'rb'))
+                if eval_metric == 'CIDEr' and eval_metric not in self.bcmrscores:
+                    eval_metric = 'cider'
+                self.bcmrscores = self.bcmrscores[eval_metric]
+                # assuming now that videos order are same (which is the sorted videos order)
+                self.bcmrscores_rows = np.arange(self.num_videos)
 
-        if self.mode == 'train':
+        # ring of batch buffers that are reused, 0 = allocate every batch
+        assert self.num_buffers == 0 or self.num_buffers >= self.prefetch + 2, \
+            'num_buffers must be at least prefetch + 2'
+        # without a ring, each batch would allocate new shared memory
+        assert self.share_buffers == 0 or self.num_buffers > 0, \
+            'share_buffers needs num_buffers > 0'
+        self.buffers = [self.new_buffer() for _ in range(self.num_buffers)]
+        self.buffer_ix = 0
+
+        if self.mode == 'train' or self.world_size > 1:
             self.shuffle_videos()
+        if self.world_size > 1:
+            logger.info('Rank %d/%d: %d videos per epoch', self.rank,
+                        self.world_size, len(self.index))
 
     def close(self):
-        self.label_h5.close()
+        self.stop_prefetch()
+        if self.feat_h5 is not None and self.feat_h5_pid == os.getpid():
+            for f in self.feat_h5:
+                if isinstance(f, h5py.File):
+                    f.close()
+        self.feat_h5 = None
+        self.feat_h5_pid = None
+        for segment in self.shm_segments:
+            if segment is not None:
+                segment.detach()
+
+    def remap_vocab(self, vocab):
+        """Encode the labels with the given vocabulary. The words that are
+        not in it become <unk>.
+        """
+        assert vocab[0] == self.vocab[0], \
+            'both vocabularies must start with the <eos> token'
+        wtoi = {w: i for i, w in enumerate(vocab)}
+        unk_ix = wtoi[UNK_TOKEN]
+        missing = [w for w in self.vocab if w not in wtoi]
+        logger.info('Remapping labels to a vocabulary of %d words, %d/%d words become %s',
+                    len(vocab), len(missing), len(self.vocab), UNK_TOKEN)
+
+        if self.has_label:
+            mapping = torch.tensor([wtoi.get(w, unk_ix) for w in self.vocab])
+            self.labels = mapping[self.labels]
+        self.vocab = list(vocab)
+        self.ix_to_word = {i: w for i, w in enumerate(self.vocab)}
+
+    def get_feat_h5(self):
+        """Feature files (h5 files or memory-mapped packed arrays) opened by
+        the current process. They are opened on first use, and opened again
+        in a forked child process instead of using the parent handles.
+        """
+        if self.feat_h5_pid != os.getpid():
+            self.feat_h5 = [
+                segment.feats if segment is not None else
+                store.open_feats(f) if store is not None else
+                np.load(f, mmap_mode='r') if f.endswith('.npy') else h5py.File(
+                    f, 'r', **chunk_cache)
+                for f, segment, store, chunk_cache in zip(
+                    self.feat_h5_files, self.shm_segments, self.feat_stores,
+                    self.chunk_caches)
+            ]
+            self.feat_h5_pid = os.getpid()
+            if self.bulk_read == 1:
+                self.index_feat_h5()
+        return self.feat_h5
+
+    def index_feat_h5(self):
+        """Resolve the dataset of every video in each h5 feature file once,
+        so that batches look them up by video index instead of by name.
+        Also keep their storage offsets, inf if not stored contiguously,
+        and their storage sizes.
+        """
+        self.feat_dsets = []
+        self.feat_offsets = []
+        self.feat_sizes = []
         for f in self.feat_h5:
-            f.close()
+            if isinstance(f, h5py.File):
+                dsets = [f[v] for v in self.videos]
+                offsets = [ds.id.get_offset() for ds in dsets]
+                offsets = np.array(
+                    [np.inf if o is None else o for o in offsets])
+                sizes = np.array([ds.id.get_storage_size() for ds in dsets])
+            else:
+                dsets, offsets, sizes = None, None, None
+            self.feat_dsets.append(dsets)
+            self.feat_offsets.append(offsets)
+            self.feat_sizes.append(sizes)
+
+    def init_worker(self, worker_id):
+        """Prepare the loader to be used by a worker (thread or process).
+        Each worker gets its own RNG stream for caption sampling, seeded by
+        (seed, rank, worker_id), so that the workers are decorrelated and
+        reproducible. Feature files are reopened by the worker process.
+        """
+        self.worker_id = worker_id
+        self.rng = np.random.RandomState([self.seed, self.rank, worker_id])
+        if self.feat_h5_pid != os.getpid():
+            # a prefetching thread of the parent does not exist here
+            self.prefetcher = None
+
+    def __getstate__(self):
+        # open files and threads cannot be pickled, e.g. to spawn workers
+        state = self.__dict__.copy()
+        state['feat_h5'] = None
+        state['feat_h5_pid'] = None
+        state['feat_dsets'] = None
+        state['prefetcher'] = None
+        return state
 
     def get_batch(self):
+        """Return the next batch.
 
-        video_batch = []
-        for dim in self.feat_dims:
-            feat = torch.zeros(self.batch_size, self.num_chunks, dim)
-            video_batch.append(feat)
+        If prefetch > 0, batches are assembled by a background thread and the
+        loader state (index, iterator, epoch) is updated to the state right
+        after the returned batch, so epoch accounting is the same as in the
+        synchronous mode. The RNG states right after the returned batch are
+        kept as well (the thread has already drawn the next batches), see
+        get_state. With exact_final_batch, the thread stops after the last
+        batch of the pass, and a new one starts if more batches are asked.
+        """
+        if self.prefetch > 0:
+            if self.prefetcher is None:
+                self.rng_state = self.get_rng_state()
+                self.prefetcher = BatchPrefetcher(self, self.prefetch)
+            epoch = self.epoch
+            data, (self.index, self.iterator,
+                   self.epoch), self.rng_state = self.prefetcher.get()
+            if self.exact_final_batch == 1 and self.epoch > epoch:
+                self.stop_prefetch()
+            return data
 
-        if self.has_label:
-            label_batch = torch.zeros(
-                (self.batch_size * self.seq_per_img, self.seq_length),
-                dtype=torch.long)
-            mask_batch = torch.zeros(self.batch_size * self.seq_per_img,
-                                     self.seq_length)
+        batch_ix, (self.index, self.iterator, self.epoch) = \
+            self.sample_indices(self.index, self.iterator, self.epoch)
+        return self.load_batch(batch_ix)
+
+    def stop_prefetch(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+            # forget the draws of the dropped batches
+            self.set_rng_state(self.rng_state)
 
-        videoids_batch = []
-        gts = []
-        bcmrscores = np.zeros(
-            (self.batch_size,
-             self.seq_per_img)) if self.bcmrscores_pkl is not None else None
+    def get_rng_state(self):
+        """States of the RNGs drawn by the loader: its caption sampling RNG
+        and the RNG that shuffles the epochs
+        """
+        return {'rng': self.rng.get_state(),
+                'shuffle_rng': self.shuffle_rng.get_state()}
 
+    def set_rng_state(self, state):
+        self.rng.set_state(state['rng'])
+        if 'shuffle_rng' in state:
+            self.shuffle_rng.set_state(state['shuffle_rng'])
+
+    def sample_indices(self, index, iterator, epoch):
+        """Draw the video indices of the next batch from the given state.
+        Returns the indices and the advanced (index, iterator, epoch) state.
+        A new index list is created when shuffling at the end of an epoch,
+        so the input state is never modified.
+        If exact_final_batch is set, the last batch of an epoch is cut short
+        instead of being filled with the videos of the next epoch.
+        """
+        batch_ix = []
         for ii in range(self.batch_size):
-            idx = self.index[self.iterator]
-            video_id = int(self.videos[idx])
-            videoids_batch.append(video_id)
+            batch_ix.append(index[iterator])
 
-            for jj in range(self.num_feats):
-                video_batch[jj][ii] = torch.from_numpy(
-                    np.array(self.feat_h5[jj][str(video_id)]))
+            iterator += 1
+            if iterator >= len(index):
+                logger.info('===> Finished loading epoch %d', epoch)
+                iterator = 0
+                epoch += 1
+                if self.mode == 'train' or self.world_size > 1:
+                    index = self.epoch_index(index, epoch)
+                if self.exact_final_batch == 1:
+                    break
 
-            if self.has_label:
-                # fetch the sequence labels
-                ix1 = self.label_start_ix[idx]
-                ix2 = self.label_end_ix[idx]
-                ncap = ix2 - ix1  # number of captions available for this image
-                assert ncap > 0, 'No captions!!'
-
-                seq = torch.zeros(self.seq_per_img, self.seq_length)
-                seq_all = torch.from_numpy(
-                    np.array(self.label_h5['labels'][ix1:ix2]))
-
-                if ncap <= self.seq_per_img:
-                    seq[:ncap] = seq_all[:ncap]
-                    for q in range(ncap, self.seq_per_img):
-                        ixl = np.random.randint(ncap)
-                        seq[q] = seq_all[ixl]
-                else:
-                    randpos = torch.randperm(ncap)
-                    for q in range(self.seq_per_img):
-                        ixl = randpos[q]
-                        seq[q] = seq_all[ixl]
+        return batch_ix, (index, iterator, epoch)
 
-                il = ii * self.seq_per_img
-                label_batch[il:il + self.seq_per_img] = seq
+    def load_batch(self, batch_ix):
+        """Read features and labels of the given video indices"""
 
-                # Used for reward evaluation
-                gts.append(self.label_h5['labels'][self.label_start_ix[idx]:
-                                                   self.label_end_ix[idx]])
+        buf = self.next_buffer(len(batch_ix))
+        video_batch = list(buf['feats'])
 
-                # pre-computed cider scores,
-                # assuming now that videos order are same (which is the sorted videos order)
-                if self.bcmrscores_pkl is not None:
-                    bcmrscores[ii] = self.bcmrscores[idx]
+        videoids_batch = [self.video_ids[idx] for idx in batch_ix]
+        for jj in range(self.num_feats):
+            start = time.time()
+            if self.chunk_offsets[jj] is not None:
+                video_batch[jj], num_bytes, num_calls = self.read_ragged_feats(
+                    jj, batch_ix)
+            elif self.feat_rows[jj] is not None:
+                num_bytes, num_calls = self.read_packed_feats(
+                    jj, batch_ix, video_batch[jj].numpy())
+            elif self.bulk_read == 1:
+                num_bytes, num_calls = self.read_feats(
+                    jj, batch_ix, video_batch[jj].numpy())
+            else:
+                num_bytes, num_calls = 0, len(videoids_batch)
+                for ii, video_id in enumerate(videoids_batch):
+                    ds = self.get_feat_h5()[jj][str(video_id)]
+                    num_bytes += ds.id.get_storage_size()
+                    feat = np.array(ds)
+                    if self.feat_scales[jj] is not None:
+                        feat = feat * self.feat_scales[jj]
+                    video_batch[jj][ii] = torch.from_numpy(feat)
+            self.io_time[jj] += time.time() - start
+            self.io_bytes[jj] += num_bytes
+            self.io_calls[jj] += num_calls
+
+        if self.has_label:
+            label_batch, mask_batch, gts = self.sample_labels(
+                batch_ix, buf['labels'], buf['masks'])
 
-            self.iterator += 1
-            if self.iterator >= self.num_videos:
-                logger.info('===> Finished loading epoch %d', self.epoch)
-                self.iterator = 0
-                self.epoch += 1
-                if self.mode == 'train':
-                    self.shuffle_videos()
+            # pre-computed cider scores
+            bcmrscores = self.bcmrscores[self.bcmrscores_rows[
+                batch_ix]] if self.bcmrscores_pkl is not None else None
 
         data = {}
         data['feats'] = video_batch
         data['ids'] = videoids_batch
 
         if self.has_label:
-            # + 1 here to count the <eos> token, because the <eos> token is set to 0
-            nonzeros = np.array(
-                list(map(lambda x: (x != 0).sum() + 1, label_batch)))
-            for ix, row in enumerate(mask_batch):
-                row[:nonzeros[ix]] = 1
-
             data['labels'] = label_batch
             data['masks'] = mask_batch
             data['gts'] = gts
@@ -169,13 +441,267 @@ class DataLoader():
 
         return data
 
+    def sample_labels(self, batch_ix, label_batch, mask_batch):
+        """Sample seq_per_img captions for each video of the batch into
+        label_batch and set their masks in mask_batch.
+        A video with at most seq_per_img captions takes all of them in order,
+        then random ones of them, otherwise a random subset of its captions.
+        Returns the labels, their masks, and all captions of each video
+        """
+        batch_size = len(batch_ix)
+        start_ix = self.label_start_ix[batch_ix]
+        end_ix = self.label_end_ix[batch_ix]
+        ncap = end_ix - start_ix  # number of captions available for each video
+        assert np.all(ncap > 0), 'No captions!!'
+
+        pos = np.tile(np.arange(self.seq_per_img), (batch_size, 1))
+        rand_pos = self.rng.randint(
+            ncap[:, np.newaxis], size=(batch_size, self.seq_per_img))
+        pos = np.where(pos < ncap[:, np.newaxis], pos, rand_pos)
+
+        many = ncap > self.seq_per_img
+        if many.any():
+            # random permutations, by sorting random keys of valid captions
+            ncap_many = ncap[many, np.newaxis]
+            keys = self.rng.rand(len(ncap_many), ncap_many.max())
+            keys[np.arange(keys.shape[1]) >= ncap_many] = 2
+            pos[many] = np.argsort(keys, 1)[:, :self.seq_per_img]
+
+        rows = torch.from_numpy((start_ix[:, np.newaxis] + pos).reshape(-1))
+        torch.index_select(self.labels, 0, rows, out=label_batch)
+
+        # + 1 here to count the <eos> token, because the <eos> token is set to 0
+        nonzeros = (label_batch != 0).sum(1) + 1
+        mask_batch.copy_(self.mask_positions < nonzeros.unsqueeze(1))
+
+        self.num_steps += min(nonzeros.max().item(), self.seq_length)
+        self.num_label_batches += 1
+
+        # Used for reward evaluation
+        gts = [
+            self.labels[ix1:ix2].numpy() for ix1, ix2 in zip(start_ix, end_ix)
+        ]
+
+        return label_batch, mask_batch, gts
+
+    def new_buffer(self):
+        """Allocate the tensors of a batch"""
+        buf = {}
+        # ragged features have a different size in every batch
+        buf['feats'] = [
+            torch.zeros(self.batch_size, self.num_chunks, dim)
+            if offsets is None else None
+            for dim, offsets in zip(self.feat_dims, self.chunk_offsets)
+        ]
+        tensors = [f for f in buf['feats'] if f is not None]
+
+        if self.has_label:
+            buf['labels'] = torch.zeros(
+                (self.batch_size * self.seq_per_img, self.seq_length),
+                dtype=torch.long)
+            buf['masks'] = torch.zeros(self.batch_size * self.seq_per_img,
+                                       self.seq_length)
+            tensors += [buf['labels'], buf['masks']]
+
+        if self.share_buffers == 1:
+            # so that worker processes can fill the batch without copies
+            for t in tensors:
+                t.share_memory_()
+
+        return buf
+
+    def next_buffer(self, batch_size):
+        """Take the next buffer of the ring, or a new one if there is no ring.
+        For a short batch, the tensors are cut to its batch_size videos.
+        """
+        if self.num_buffers == 0:
+            buf = self.new_buffer()
+        else:
+            buf = self.buffers[self.buffer_ix]
+            self.buffer_ix = (self.buffer_ix + 1) % self.num_buffers
+
+        if batch_size < self.batch_size:
+            num_seqs = batch_size * self.seq_per_img
+            short_buf = {
+                'feats': [
+                    f[:batch_size] if f is not None else None
+                    for f in buf['feats']
+                ]
+            }
+            if self.has_label:
+                short_buf['labels'] = buf['labels'][:num_seqs]
+                short_buf['masks'] = buf['masks'][:num_seqs]
+            buf = short_buf
+        return buf
+
+    def get_feat_store(self, feat_file):
+        """Store of a feature file of an appendable store, None for other
+        files. The features of the store of the labels are read at the same
+        version as the labels.
+        """
+        if not feat_file.endswith('.bin'):
+            return None
+        root = os.path.dirname(feat_file) or '.'
+        if self.label_store is not None and os.path.samefile(
+                root, self.label_store.root):
+            return self.label_store
+        return FeatureStore(root)
+
+    def open_packed_feats(self, feat_file, store=None):
+        """Memory-map a packed feature array (or the features of a store)
+        and map the loader videos to its rows. Also returns the offsets of
+        the chunks of each row if the array is ragged, None otherwise.
+        """
+        if store is not None:
+            feats = store.open_feats(feat_file)
+            packed_videos = store.videos
+        else:
+            feats = np.load(feat_file, mmap_mode='r')
+            packed_videos = json.load(open(packed_videos_file(feat_file)))
+
+        offsets_file = packed_offsets_file(feat_file)
+        if store is None and os.path.exists(offsets_file):
+            offsets = np.load(offsets_file)
+            assert len(offsets) == len(packed_videos) + 1
+            assert offsets[-1] == feats.shape[0]
+            logger.info('Ragged features %s: %.1f chunks per video', feat_file,
+                        offsets[-1] / max(1., len(packed_videos)))
+        else:
+            offsets = None
+            assert feats.shape[0] == len(packed_videos)
+
+        return feats, self.map_rows(packed_videos, feat_file), offsets
+
+    def map_rows(self, file_videos, file_name):
+        """Rows of the loader videos in a file whose rows are file_videos"""
+        if file_videos == self.videos:
+            return np.arange(self.num_videos)
+
+        logger.info('Videos of %s are not in the label order, remapping',
+                    file_name)
+        row_of = {v: i for i, v in enumerate(file_videos)}
+        missing = [v for v in self.videos if v not in row_of]
+        assert len(missing) == 0, \
+            'Videos not found in {}: {}'.format(file_name, missing[:10])
+        return np.array([row_of[v] for v in self.videos])
+
+    def read_packed_feats(self, jj, batch_ix, out):
+        """Gather the rows of batch_ix from the jj-th packed feature array
+        into out (batch x chunks x dim). Returns the bytes and the number of
+        reads (a single gather).
+        """
+        rows = self.feat_rows[jj][batch_ix]
+        # gather in increasing row order to read the mapped file sequentially
+        order = np.argsort(rows, kind='stable')
+        feats = self.get_feat_h5()[jj][rows[order]]
+        num_bytes = feats.nbytes
+        if self.feat_scales[jj] is not None:
+            feats = feats * self.feat_scales[jj]
+        if feats.shape[1:] == out.shape[1:]:
+            out[order] = feats
+        else:
+            out[order] = feats[:, np.newaxis]
+        return num_bytes, 1
+
+    def read_ragged_feats(self, jj, batch_ix):
+        """Gather the chunks of the videos batch_ix from the jj-th ragged
+        packed array. Returns the chunks of all videos packed in batch order
+        (total chunks x dim) and the number of chunks of each video, the bytes
+        and the number of reads (a single gather).
+        """
+        rows = self.feat_rows[jj][batch_ix]
+        starts = self.chunk_offsets[jj][rows]
+        lengths = self.chunk_offsets[jj][rows + 1] - starts
+
+        # chunk index of each position of the packed batch
+        first = np.cumsum(lengths) - lengths
+        index = np.repeat(starts - first, lengths) + np.arange(lengths.sum())
+
+        # gather in increasing order to read the mapped file sequentially
+        order = np.argsort(index, kind='stable')
+        chunks = np.empty((len(index), self.feat_dims[jj]), dtype=np.float32)
+        feats = self.get_feat_h5()[jj][index[order]]
+        num_bytes = feats.nbytes
+        if self.feat_scales[jj] is not None:
+            feats = feats * self.feat_scales[jj]
+        chunks[order] = feats
+
+        feat = (torch.from_numpy(chunks), torch.from_numpy(lengths))
+        return feat, num_bytes, 1
+
+    def read_feats(self, jj, batch_ix, out):
+        """Read the features of the videos batch_ix from the jj-th feature
+        file directly into out (batch x chunks x dim), in storage order.
+        Returns the bytes and the number of datasets read from the file.
+        """
+        self.get_feat_h5()
+        dsets = self.feat_dsets[jj]
+        batch = list(range(len(batch_ix)))
+
+        if self.feat_cache is not None:
+            keys = [(self.feat_h5_files[jj], self.video_ids[idx])
+                    for idx in batch_ix]
+            missing = []
+            for ii in batch:
+                feat = self.feat_cache.get(keys[ii])
+                if feat is None:
+                    missing.append(ii)
+                else:
+                    out[ii] = feat
+            batch = missing
+
+        # datasets that are not stored contiguously are read last in batch order
+        batch_offsets = self.feat_offsets[jj][np.asarray(batch_ix)[batch]]
+        order = [batch[k] for k in np.argsort(batch_offsets, kind='stable')]
+
+        for ii in order:
+            ds = dsets[batch_ix[ii]]
+            if ds.shape == out.shape[1:]:
+                ds.read_direct(out[ii])
+            else:
+                # a single chunk is shared by all chunks of the batch
+                ds.read_direct(out[ii, 0])
+                out[ii, 1:] = out[ii, 0]
+
+        # float16 and int8 features are converted to float32 by read_direct
+        if self.feat_scales[jj] is not None and len(order) > 0:
+            out[order] *= self.feat_scales[jj]
+
+        if self.feat_cache is not None:
+            for ii in order:
+                self.feat_cache.put(keys[ii], out[ii].copy())
+
+        read_ix = [batch_ix[ii] for ii in order]
+        return int(self.feat_sizes[jj][read_ix].sum()), len(order)
+
+    def get_feat_cache_stats(self):
+        return self.feat_cache.get_stats() if self.feat_cache is not None else None
+
+    def get_io_stats(self, reset=False):
+        """Bytes, read calls and seconds spent reading each feature file
+        since the start, or since the last reset
+        """
+        stats = [{
+            'file': os.path.basename(f),
+            'bytes': int(self.io_bytes[jj]),
+            'calls': int(self.io_calls[jj]),
+            'time': float(self.io_time[jj])
+        } for jj, f in enumerate(self.feat_h5_files)]
+        if reset:
+            self.io_bytes[:] = 0
+            self.io_calls[:] = 0
+            self.io_time[:] = 0
+        return stats
+
     def reset(self):
+        self.stop_prefetch()
         self.iterator = 0
 
     def get_current_index(self):
         return self.iterator
 
     def set_current_index(self, index):
+        self.stop_prefetch()
         self.iterator = index
 
     def get_vocab(self):
@@ -209,10 +735,749 @@ class DataLoader():
         return self.epoch
 
     def set_current_epoch(self, epoch):
+        self.stop_prefetch()
         self.epoch = epoch
+        if self.world_size > 1:
+            self.index = self.epoch_index(self.index, epoch)
+
+    def get_state(self):
+        """Position of the loader, to resume it exactly with set_state.
+        With prefetching, this is the state before the first batch not yet
+        returned by get_batch, not the state of the prefetching thread.
+        """
+        state = {
+            'index': list(self.index),
+            'iterator': self.iterator,
+            'epoch': self.epoch
+        }
+        state.update(self.rng_state if self.prefetcher is not None else
+                     self.get_rng_state())
+        return state
+
+    def set_state(self, state):
+        self.stop_prefetch()
+        self.index = list(state['index'])
+        self.iterator = state['iterator']
+        self.epoch = state['epoch']
+        self.set_rng_state(state)
+
+    def get_avg_steps(self):
+        """Average number of RNN steps (longest caption) per batch"""
+        return self.num_steps / max(1, self.num_label_batches)
+
+    def get_shuffle_randomness(self):
+        """Randomness of the last block shuffled epoch order (None if off)"""
+        return getattr(self, 'shuffle_randomness', None)
+
+    def epoch_index(self, index, epoch):
+        """Order of the videos for the given epoch, given the previous one.
+        Returns a new list, the previous one is not modified.
+        """
+        if self.world_size > 1:
+            index = self.shard_index(epoch)
+        else:
+            index = list(index)
+            self.shuffle_rng.shuffle(index)
+
+        if self.block_size > 0 and self.mode == 'train':
+            index = self.block_shuffle_index(index)
+        if self.length_bucketing == 1 and self.mode == 'train':
+            index = self.bucket_index(index)
+        return index
+
+    def get_storage_rank(self):
+        """Position of each video in the storage order of the first feature
+        file (row of a packed array, or byte offset in a h5 file)
+        """
+        if self.feat_rows[0] is not None:
+            position = self.feat_rows[0]
+        else:
+            with h5py.File(self.feat_h5_files[0], 'r') as f:
+                position = [f[v].id.get_offset() for v in self.videos]
+            position = [np.inf if p is None else p for p in position]
+        return np.argsort(np.argsort(position, kind='stable'))
+
+    def block_shuffle_index(self, index):
+        """Shuffle with locality: the videos are sorted in storage order and
+        cut into blocks of block_size videos, the blocks are shuffled, then
+        the videos are shuffled within each window of block_window blocks.
+        A batch thus reads from a few contiguous regions of the files.
+        """
+        index = np.asarray(index)
+        index = index[np.argsort(self.storage_rank[index])]
+
+        blocks = [
+            index[i:i + self.block_size]
+            for i in range(0, len(index), self.block_size)
+        ]
+        blocks = [blocks[i] for i in self.shuffle_rng.permutation(len(blocks))]
+
+        window_size = self.block_size * self.block_window
+        index = np.concatenate(blocks)
+        for i in range(0, len(index), window_size):
+            self.shuffle_rng.shuffle(index[i:i + window_size])
+
+        self.shuffle_randomness = self.get_randomness(index)
+        logger.info('Block shuffle randomness: %.4f (1 = full shuffle)',
+                    self.shuffle_randomness)
+        return index.tolist()
+
+    def get_randomness(self, index):
+        """Randomness of the storage order of the videos of index, see
+        order_randomness
+        """
+        rank = np.argsort(np.argsort(self.storage_rank[index]))
+        return order_randomness(rank)
+
+    def bucket_index(self, index):
+        """Group videos with similar caption lengths into the same batches.
+        The videos are sorted by the length of their longest caption (ties
+        broken at random), cut into batches, and the batches are shuffled.
+        A random remainder of len(index) % batch_size videos goes last.
+        """
+        index = np.asarray(index)
+        num_rest = len(index) % self.batch_size
+        rest, index = index[:num_rest], index[num_rest:]
+
+        keys = self.video_lengths[index] + self.shuffle_rng.rand(len(index))
+        batches = index[np.argsort(keys)].reshape(-1, self.batch_size)
+        batches = batches[self.shuffle_rng.permutation(len(batches))]
+
+        return np.concatenate([batches.reshape(-1), rest]).tolist()
+
+    def shard_index(self, epoch):
+        """Videos of this rank at the given epoch.
+        All ranks draw the same permutation from (seed, epoch) and take every
+        world_size-th video of it, so the shards are disjoint and have the
+        same length. In train mode the remainder videos are dropped for this
+        epoch; in test mode the permutation is padded with its first videos
+        so that every video is seen.
+        """
+        if self.mode == 'train':
+            perm = np.random.RandomState(self.seed + epoch).permutation(
+                self.num_videos)
+            num_shard = self.num_videos // self.world_size
+        else:
+            perm = np.arange(self.num_videos)
+            num_shard = -(-self.num_videos // self.world_size)
+            perm = np.concatenate(
+                [perm, perm[:num_shard * self.world_size - self.num_videos]])
+
+        return perm[self.rank:num_shard * self.world_size:self.world_size].tolist()
 
     def shuffle_videos(self):
-        np.random.shuffle(self.index)
+        self.stop_prefetch()
+        self.index = self.epoch_index(self.index, self.epoch)
 
     def get_cocofmt_file(self):
         return self.cocofmt_file
+
+
+class MixtureLoader():
+    """Load training batches from several datasets, each with its own label
+    file and feature files, without merging them on disk.
+
+    Each batch comes from one dataset, drawn with the mixture weights. The
+    draws only depend on the seed, so that all ranks take the same dataset
+    at each iteration and keep disjoint shards of it. The labels of all
+    datasets are encoded with a common vocabulary (vocab_json, or else the
+    vocabulary of the first dataset). An epoch is as many videos as all the
+    datasets together.
+    """
+
+    def __init__(self, opt):
+        label_h5_files = opt['label_h5']
+        feat_h5_files = opt['feat_h5']
+        self.num_sources = len(label_h5_files)
+        assert len(feat_h5_files) % self.num_sources == 0, \
+            'each dataset must have the same number of feature files'
+        num_feats = len(feat_h5_files) // self.num_sources
+
+        weights = opt.get('mixture_weights') or [1.] * self.num_sources
+        assert len(weights) == self.num_sources, \
+            'one mixture weight is needed per dataset'
+        self.weights = np.array(weights, dtype=float) / sum(weights)
+        bcmrscores_pkls = opt.get('bcmrscores_pkl') or [None] * self.num_sources
+        assert len(bcmrscores_pkls) == self.num_sources
+
+        vocab_json = opt.get('vocab_json', None)
+        if vocab_json is not None:
+            self.vocab = json.load(open(vocab_json))
+        else:
+            with h5py.File(label_h5_files[0], 'r') as f:
+                self.vocab = [i.decode() for i in f['vocab']]
+
+        self.loaders = []
+        for ii, label_h5_file in enumerate(label_h5_files):
+            source_opt = dict(opt)
+            source_opt.update({
+                'label_h5': label_h5_file,
+                'feat_h5': feat_h5_files[ii * num_feats:(ii + 1) * num_feats],
+                'bcmrscores_pkl': bcmrscores_pkls[ii],
+                'vocab': self.vocab,
+                'source': ii
+            })
+            self.loaders.append(DataLoader(source_opt))
+
+        assert all(l.get_feat_dims() == self.loaders[0].get_feat_dims()
+                   for l in self.loaders), \
+            'all datasets must have the same features'
+        for label_h5_file, loader, weight in zip(label_h5_files, self.loaders,
+                                                 self.weights):
+            logger.info('Mixture: %s, %d videos, weight %.3f', label_h5_file,
+                        len(loader.index), weight)
+
+        self.has_label = True
+        self.batch_size = self.loaders[0].get_batch_size()
+        self.seq_per_img = self.loaders[0].get_seq_per_img()
+        self.num_videos = sum(len(l.index) for l in self.loaders)
+        self.iterator = 0
+        self.epoch = 0
+        self.rng = np.random.RandomState(opt.get('seed', 123))
+        self.source_counts = np.zeros(self.num_sources, dtype=int)
+
+    def close(self):
+        for loader in self.loaders:
+            loader.close()
+
+    def get_batch(self):
+        source = self.rng.choice(self.num_sources, p=self.weights)
+        data = self.loaders[source].get_batch()
+        self.source_counts[source] += 1
+
+        self.iterator += len(data['ids'])
+        if self.iterator >= self.num_videos:
+            logger.info('===> Finished loading mixture epoch %d, batches per dataset: %s',
+                        self.epoch, self.source_counts.tolist())
+            self.iterator -= self.num_videos
+            self.epoch += 1
+        return data
+
+    def get_vocab(self):
+        return {i: w for i, w in enumerate(self.vocab)}
+
+    def get_vocab_size(self):
+        return len(self.vocab)
+
+    def get_feat_dims(self):
+        return self.loaders[0].get_feat_dims()
+
+    def get_feat_size(self):
+        return sum(self.get_feat_dims())
+
+    def get_num_feats(self):
+        return self.loaders[0].get_num_feats()
+
+    def get_seq_length(self):
+        return max(l.get_seq_length() for l in self.loaders)
+
+    def get_seq_per_img(self):
+        return self.seq_per_img
+
+    def get_num_videos(self):
+        return self.num_videos
+
+    def get_batch_size(self):
+        return self.batch_size
+
+    def get_current_epoch(self):
+        return self.epoch
+
+    def set_current_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_state(self):
+        return {
+            'iterator': self.iterator,
+            'epoch': self.epoch,
+            'rng': self.rng.get_state(),
+            'source_counts': self.source_counts.tolist(),
+            'sources': [l.get_state() for l in self.loaders]
+        }
+
+    def set_state(self, state):
+        self.iterator = state['iterator']
+        self.epoch = state['epoch']
+        self.rng.set_state(state['rng'])
+        self.source_counts = np.array(state['source_counts'])
+        for loader, source_state in zip(self.loaders, state['sources']):
+            loader.set_state(source_state)
+
+    def get_avg_steps(self):
+        num_steps = sum(l.num_steps for l in self.loaders)
+        num_batches = sum(l.num_label_batches for l in self.loaders)
+        return num_steps / max(1, num_batches)
+
+    def get_feat_cache_stats(self):
+        return None
+
+    def get_io_stats(self, reset=False):
+        return sum([l.get_io_stats(reset) for l in self.loaders], [])
+
+    def get_cocofmt_file(self):
+        return None
+
+
+def order_randomness(rank):
+    """Mean distance between consecutive values of rank (a permutation of
+    0..n-1), relative to its expected value (n + 1) / 3 for a uniform
+    shuffle: 3 / (n + 1) (close to 0) for the sorted order, about 1 for a
+    full shuffle (exactly 1 on average over all permutations).
+
+    >>> import itertools
+    >>> round(float(np.mean([order_randomness(p)
+    ...                      for p in itertools.permutations(range(6))])), 6)
+    1.0
+    >>> round(float(order_randomness(np.random.RandomState(0).permutation(
+    ...     10000))), 2)
+    1.01
+    >>> round(float(order_randomness(np.arange(10000))), 4)
+    0.0003
+    """
+    n = len(rank)
+    if n < 2:
+        return 0.
+    return np.abs(np.diff(rank)).mean() / ((n + 1) / 3.)
+
+
+def is_feature_store(path):
+    """Whether path is an appendable store (its directory, or the manifest
+    of one of its versions) rather than a label h5 file
+    """
+    return os.path.isdir(path) or path.endswith('.json')
+
+
+def store_feat_file(root, name):
+    """File of the features of a store"""
+    return os.path.join(root, 'feat_%s.bin' % name)
+
+
+class FeatureStore():
+    """Version of an appendable store of videos, with their vocab-encoded
+    captions and their features (see ingest_videos.py).
+
+    Each array is a raw file that only grows: new videos are appended at its
+    end, then a manifest with the new sizes replaces manifest.json. A store
+    opened at a version only uses the rows of its manifest, so it is not
+    affected by later ingestions. Each version is also kept as
+    manifest_<version>.json, to open the store at that version.
+    """
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            self.root = path
+            path = os.path.join(path, 'manifest.json')
+        else:
+            self.root = os.path.dirname(path) or '.'
+        self.manifest = json.load(open(path))
+        self.version = self.manifest['version']
+        self.num_videos = self.manifest['num_videos']
+        self.num_captions = self.manifest['num_captions']
+        self.seq_length = self.manifest['seq_length']
+
+        self.vocab = json.load(open(self.file('vocab.json')))
+        # lines past num_videos belong to a later (or failed) ingestion
+        with open(self.file('videos.txt')) as f:
+            self.videos = [next(f).rstrip('\n') for _ in range(self.num_videos)]
+        logger.info('Opened store %s at version %d: %d videos, %d captions',
+                    self.root, self.version, self.num_videos, self.num_captions)
+
+    def file(self, name):
+        return os.path.join(self.root, name)
+
+    def open_array(self, name, dtype, shape, num_rows):
+        """Memory-map the first num_rows rows of a raw file"""
+        if num_rows == 0:
+            return np.zeros((0, ) + tuple(shape), dtype=dtype)
+        return np.memmap(
+            self.file(name),
+            dtype=dtype,
+            mode='r',
+            shape=(num_rows, ) + tuple(shape))
+
+    def open_feats(self, feat_file):
+        name = os.path.basename(feat_file)[len('feat_'):-len('.bin')]
+        info = self.manifest['feats'][name]
+        return self.open_array(
+            os.path.basename(feat_file), info['dtype'], info['shape'],
+            self.num_videos)
+
+    def get_labels(self):
+        """Videos, vocab and labels in the layout of a label h5 file
+        (see create_sequencelabel.py)
+        """
+        labels = {
+            'videos': np.array(self.videos, dtype=np.bytes_),
+            'vocab': np.array(self.vocab, dtype=np.bytes_)
+        }
+        if self.num_captions > 0:
+            label_ix = self.open_array('label_ix.bin', np.int64, (2, ),
+                                       self.num_videos)
+            labels['labels'] = self.open_array(
+                'labels.bin', np.int32, (self.seq_length, ), self.num_captions)
+            labels['label_start_ix'] = label_ix[:, 0]
+            labels['label_end_ix'] = label_ix[:, 1]
+            labels['label_length'] = self.open_array(
+                'label_length.bin', np.int32, (), self.num_captions)
+        return labels
+
+
+def chunk_cache_kwargs(opt, ii):
+    """h5py.File arguments setting the raw data chunk cache of the ii-th
+    feature file. Each option has one value per feature type (the feature
+    files of a loader, which are the same for each dataset of a
+    MixtureLoader), or a single value for all of them; the h5py defaults
+    are kept if it is not set.
+    """
+
+    def value(key):
+        values = opt.get(key)
+        if not values:
+            return None
+        assert len(values) in [1, len(opt['feat_h5'])], \
+            '{} needs one value, or one per feature type'.format(key)
+        return values[ii] if len(values) > 1 else values[0]
+
+    kwargs = {}
+    if value('chunk_cache_mb') is not None:
+        kwargs['rdcc_nbytes'] = int(value('chunk_cache_mb') * 2**20)
+    if value('chunk_cache_slots') is not None:
+        kwargs['rdcc_nslots'] = int(value('chunk_cache_slots'))
+    if value('chunk_cache_w0') is not None:
+        kwargs['rdcc_w0'] = float(value('chunk_cache_w0'))
+    return kwargs
+
+
+def packed_videos_file(packed_file):
+    """Json file listing the video of each row of a packed feature array"""
+    return os.path.splitext(packed_file)[0] + '_videos.json'
+
+
+def bcmrscores_file(scores_dir, name):
+    """File of a metric (or the 'videos' index) in a scores directory"""
+    return os.path.join(scores_dir,
+                        name + ('.json' if name == 'videos' else '.npy'))
+
+
+def packed_offsets_file(packed_file):
+    """First chunk of each row of a ragged packed feature array, and the
+    total number of chunks
+    """
+    return os.path.splitext(packed_file)[0] + '_offsets.npy'
+
+
+def packed_scale_file(packed_file):
+    """Per-dimension scales of a packed int8 feature array"""
+    return os.path.splitext(packed_file)[0] + '_scale.npy'
+
+
+def file_fingerprint(path, num_blocks=16, block_bytes=2**20):
+    """Hash of a file from its inode, size, modification and change times,
+    and num_blocks blocks spread over it, so that jobs can identify a
+    feature file without reading all of it. The change time is updated by
+    any write to the file (and cannot be set back), so a rewrite that only
+    changes bytes outside of the blocks still changes the fingerprint.
+    """
+    st = os.stat(path)
+    size = st.st_size
+    sha = hashlib.sha1(' '.join(
+        str(v) for v in [st.st_dev, st.st_ino, size, st.st_mtime_ns,
+                         st.st_ctime_ns]).encode())
+    with open(path, 'rb') as f:
+        for ii in range(num_blocks):
+            f.seek(max(0, size - block_bytes) * ii // max(1, num_blocks - 1))
+            sha.update(f.read(block_bytes))
+    return sha.hexdigest()
+
+
+class SharedFeatureSegment():
+    """Features of a h5 file for the videos of a label file, held in a named
+    segment of /dev/shm shared by the jobs of a node.
+
+    The segment is keyed by the feature file (see file_fingerprint) and the
+    list of videos. The first job fills it, the other jobs map it read-only.
+    The pids of the attached jobs are kept in a reference file, and the last
+    job to detach removes the segment. The segments left by jobs that died
+    (only dead pids in their reference file) are removed by the next job
+    that opens a segment, or taken over if it needs the same one.
+    """
+
+    shm_dir = '/dev/shm'
+
+    def __init__(self, feat_file, videos):
+        key = hashlib.sha1((file_fingerprint(feat_file) + '\n' +
+                            '\n'.join(videos)).encode()).hexdigest()[:16]
+        self.path = os.path.join(self.shm_dir, 'cst_feats_%s.npy' % key)
+        self.refs_path = os.path.join(self.shm_dir, 'cst_feats_%s.refs' % key)
+        self.pid = os.getpid()
+
+        with self.lock():
+            self.remove_dead_segments()
+            refs = self.read_refs()
+            if os.path.exists(self.path):
+                logger.info('Attaching to shared features of %s: %s (%d jobs)',
+                            feat_file, self.path, len(refs))
+            else:
+                # the other jobs wait for the segment instead of reading
+                # the file themselves
+                self.populate(feat_file, videos)
+            refs.append(self.pid)
+            self.write_refs(refs)
+
+        self.feats = np.load(self.path, mmap_mode='r')
+        with h5py.File(feat_file, 'r') as f:
+            self.scale = f.attrs.get('scale')
+        atexit.register(self.detach)
+
+    def __getstate__(self):
+        # a spawned worker maps the segment again, the parent holds the ref
+        state = self.__dict__.copy()
+        state['feats'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.feats = np.load(self.path, mmap_mode='r')
+
+    def lock(self):
+        """Lock serializing the creation, attach and detach of segments"""
+        return FileLock(os.path.join(self.shm_dir, 'cst_feats.lock'))
+
+    def read_refs(self, refs_path=None):
+        """Pids attached to the segment, without the dead ones"""
+        refs_path = refs_path or self.refs_path
+        if not os.path.exists(refs_path):
+            return []
+        refs = json.load(open(refs_path))
+        return [pid for pid in refs if pid_alive(pid)]
+
+    def remove_dead_segments(self):
+        """Remove the segments of other keys whose jobs are all dead, and
+        the partial copies of dead jobs (with the lock held)
+        """
+        for name in os.listdir(self.shm_dir):
+            path = os.path.join(self.shm_dir, name)
+            if not name.startswith('cst_feats_'):
+                continue
+            if name.endswith('.refs') and path != self.refs_path:
+                if len(self.read_refs(path)) == 0:
+                    segment_path = path[:-len('.refs')] + '.npy'
+                    logger.info('Removing shared features of dead jobs: %s',
+                                segment_path)
+                    for p in [segment_path, path]:
+                        if os.path.exists(p):
+                            os.remove(p)
+            elif name.endswith('.npy') and path != self.path:
+                # killed between its copy and its reference file
+                if os.path.exists(path) and not os.path.exists(
+                        path[:-len('.npy')] + '.refs'):
+                    os.remove(path)
+            elif name.endswith('.tmp') and '.npy.' in name:
+                # written by populate as <segment>.<pid>.tmp
+                pid = name[:-len('.tmp')].rsplit('.', 1)[-1]
+                if pid.isdigit() and not pid_alive(int(pid)):
+                    os.remove(path)
+
+    def write_refs(self, refs):
+        tmp_path = self.refs_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(refs, f)
+        os.replace(tmp_path, self.refs_path)
+
+    def populate(self, feat_file, videos):
+        logger.info('Copying features of %s to %s', feat_file, self.path)
+        start = time.time()
+        tmp_path = '%s.%d.tmp' % (self.path, self.pid)
+        try:
+            with h5py.File(feat_file, 'r') as f:
+                first = f[videos[0]]
+                feats = np.lib.format.open_memmap(
+                    tmp_path,
+                    mode='w+',
+                    dtype=first.dtype,
+                    shape=(len(videos), ) + first.shape)
+                for ii, video in enumerate(videos):
+                    f[video].read_direct(feats[ii])
+                feats.flush()
+                del feats
+            # published complete, a job never maps a partial segment
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        logger.info('Shared features: %.1f MB in %.1fs',
+                    os.path.getsize(self.path) / 2.**20, time.time() - start)
+
+    def detach(self):
+        if self.pid != os.getpid():
+            return
+        atexit.unregister(self.detach)
+        self.pid = None
+        self.feats = None
+        with self.lock() as lock:
+            # one ref per attached loader, the other loaders of this process
+            # may still map the segment
+            refs = self.read_refs()
+            if os.getpid() in refs:
+                refs.remove(os.getpid())
+            if len(refs) > 0:
+                self.write_refs(refs)
+                return
+            logger.info('Removing shared features: %s', self.path)
+            for path in [self.path, self.refs_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            if not any(
+                    name.startswith('cst_feats_')
+                    for name in os.listdir(self.shm_dir)):
+                lock.remove()
+
+
+class FileLock():
+    """Exclusive lock on a file, across processes. The holder can remove the
+    file (see remove), the next holders then lock a new one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        while True:
+            self.f = open(self.path, 'a')
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+            # the file may have been removed while we waited for it
+            try:
+                if os.path.samestat(os.fstat(self.f.fileno()),
+                                    os.stat(self.path)):
+                    return self
+            except FileNotFoundError:
+                pass
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+            self.f.close()
+
+    def remove(self):
+        """Remove the lock file, while holding the lock"""
+        os.remove(self.path)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class FeatureCache():
+    """LRU cache of video features, bounded by a budget in bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        feat = self.entries.get(key)
+        if feat is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return feat
+
+    def put(self, key, feat):
+        if feat.nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+
+        self.entries[key] = feat
+        self.nbytes += feat.nbytes
+
+        # evict the least recently used features
+        while self.nbytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.nbytes
+        }
+
+
+class BatchPrefetcher():
+    """Assemble the next batches of a DataLoader in a background thread.
+    Each queued batch is paired with the loader state and the RNG states
+    right after it, so the consumer can restore them when the batch is taken.
+    With exact_final_batch (a single pass over the videos, e.g. to evaluate),
+    the thread stops after the last batch of the pass instead of reading
+    the next pass, which reset() would drop.
+    """
+
+    def __init__(self, loader, depth):
+        self.loader = loader
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+
+        # position in the buffer ring after the last consumed batch
+        self.buffer_ix = loader.buffer_ix
+
+        state = (loader.index, loader.iterator, loader.epoch)
+        self.thread = threading.Thread(target=self.run, args=(state,))
+        self.thread.daemon = True
+        self.thread.start()
+        # a daemon thread still reading h5 files at exit would block the
+        # interpreter shutdown
+        atexit.register(self.stop)
+
+    def run(self, state):
+        try:
+            while not self.stop_event.is_set():
+                epoch = state[2]
+                batch_ix, state = self.loader.sample_indices(*state)
+                data = self.loader.load_batch(batch_ix)
+                self.put((data, state, self.loader.buffer_ix,
+                          self.loader.get_rng_state()))
+                if self.loader.exact_final_batch == 1 and state[2] > epoch:
+                    break
+        except Exception as e:
+            logger.exception('Prefetching thread failed')
+            self.put((e, None, None, None))
+
+    def put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        data, state, buffer_ix, rng_state = self.queue.get()
+        if isinstance(data, Exception):
+            raise data
+        self.buffer_ix = buffer_ix
+        return data, state, rng_state
+
+    def stop(self):
+        atexit.unregister(self.stop)
+        self.stop_event.set()
+        self.thread.join()
+        # buffers of the dropped batches are free again
+        self.loader.buffer_ix = self.buffer_ix
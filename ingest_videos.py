@@ -0,0 +1,204 @@
+"""
+Append new videos to an appendable store (see FeatureStore in dataloader.py):
+their captions, encoded with the vocab of the store, and their features read
+from feature h5 files. The first ingestion creates the store.
+
+Only the new videos are read and written: each array of the store is a raw
+file to which their rows are appended. The new version is then published at
+once by replacing the manifest of the store, so that loaders opening the
+store never see a partial ingestion.
+"""
+
+import os
+import json
+import argparse
+import h5py
+import numpy as np
+
+import logging
+from datetime import datetime
+
+from create_sequencelabel import encode_captions, select_tokens
+from dataloader import FeatureStore, FileLock, store_feat_file, packed_scale_file
+
+logger = logging.getLogger(__name__)
+
+
+def append_rows(path, data, size):
+    """Write data at the byte offset size of a raw file, dropping what is
+    past it (left there by a failed ingestion)
+    """
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+        f.seek(size)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def publish(store_dir, manifest):
+    """Write the manifest of a new version, and make it the current one"""
+    for name in ['manifest_%05d.json' % manifest['version'], 'manifest.json']:
+        tmp_file = os.path.join(store_dir, name + '.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, os.path.join(store_dir, name))
+
+
+def create_store(store_dir, vocab_json, max_length, feat_h5s, video_id,
+                 has_labels):
+    """Create an empty store, the features take the shape and type of the
+    features of video_id in feat_h5s
+    """
+    logger.info('Creating store: %s', store_dir)
+    vocab = json.load(open(vocab_json))
+    json.dump(vocab, open(os.path.join(store_dir, 'vocab.json'), 'w'))
+
+    manifest = {
+        'version': 0,
+        'num_videos': 0,
+        'num_captions': 0,
+        'videos_bytes': 0,
+        'seq_length': max_length,
+        'has_labels': has_labels,
+        'feats': {}
+    }
+    files = ['videos.txt', 'labels.bin', 'label_ix.bin', 'label_length.bin']
+    for name, feat_h5 in feat_h5s.items():
+        with h5py.File(feat_h5, 'r') as f:
+            ds = f[video_id]
+            manifest['feats'][name] = {
+                'dtype': ds.dtype.str,
+                'shape': list(ds.shape)
+            }
+            if 'scale' in f.attrs:
+                # int8 features, see quantize_features.py
+                np.save(
+                    packed_scale_file(store_feat_file(store_dir, name)),
+                    f.attrs['scale'])
+        files.append(os.path.basename(store_feat_file(store_dir, name)))
+
+    for name in files:
+        open(os.path.join(store_dir, name), 'wb').close()
+    publish(store_dir, manifest)
+
+
+def main(store_dir, captions_json, feat_h5s, vocab_json, max_length):
+
+    videos = json.load(open(captions_json))
+    os.makedirs(store_dir, exist_ok=True)
+
+    # one ingestion at a time
+    with FileLock(os.path.join(store_dir, 'store.lock')):
+        if not os.path.exists(os.path.join(store_dir, 'manifest.json')):
+            assert vocab_json is not None, 'vocab_json is needed to create a store'
+            create_store(store_dir, vocab_json, max_length, feat_h5s,
+                         str(videos[0]['video_id']),
+                         len(videos[0]['captions']) > 0)
+
+        store = FeatureStore(store_dir)
+        manifest = dict(store.manifest)
+        assert sorted(feat_h5s) == sorted(manifest['feats']), \
+            'the store has the features: {}'.format(sorted(manifest['feats']))
+
+        known = set(store.videos)
+        new_videos = [v for v in videos if str(v['video_id']) not in known]
+        if len(new_videos) < len(videos):
+            logger.info('Skipping %d videos already in the store',
+                        len(videos) - len(new_videos))
+        if len(new_videos) == 0:
+            logger.info('No new video')
+            return
+
+        logger.info('Appending %d videos to %d videos', len(new_videos),
+                    store.num_videos)
+        video_bytes = ''.join(
+            str(v['video_id']) + '\n' for v in new_videos).encode()
+        append_rows(store.file('videos.txt'), video_bytes,
+                    manifest['videos_bytes'])
+
+        if manifest['has_labels']:
+            logger.info('Encoding captions...')
+            wtoi = {w: i for i, w in enumerate(store.vocab)}
+            select_tokens(new_videos, wtoi)
+            L, label_start_ix, label_end_ix, label_length, _ = encode_captions(
+                new_videos, manifest['seq_length'], wtoi)
+            label_ix = np.stack([label_start_ix, label_end_ix],
+                                1) + store.num_captions
+
+            append_rows(
+                store.file('labels.bin'), L.astype(np.int32).tobytes(),
+                store.num_captions * manifest['seq_length'] * 4)
+            append_rows(
+                store.file('label_ix.bin'), label_ix.astype(np.int64).tobytes(),
+                store.num_videos * 2 * 8)
+            append_rows(
+                store.file('label_length.bin'),
+                label_length.astype(np.int32).tobytes(), store.num_captions * 4)
+            manifest['num_captions'] += L.shape[0]
+
+        for name, feat_h5 in feat_h5s.items():
+            logger.info('Reading %s features from: %s', name, feat_h5)
+            info = manifest['feats'][name]
+            feats = np.empty(
+                (len(new_videos), ) + tuple(info['shape']), dtype=info['dtype'])
+            with h5py.File(feat_h5, 'r') as f:
+                scale_file = packed_scale_file(store_feat_file(store_dir, name))
+                if os.path.exists(scale_file):
+                    assert np.array_equal(f.attrs.get('scale'), np.load(scale_file)), \
+                        'int8 features must have the scale of the store'
+                for ii, v in enumerate(new_videos):
+                    f[str(v['video_id'])].read_direct(feats[ii])
+
+            append_rows(
+                store_feat_file(store_dir, name), feats.tobytes(),
+                store.num_videos * feats[0].nbytes)
+
+        manifest['num_videos'] += len(new_videos)
+        manifest['videos_bytes'] += len(video_bytes)
+        manifest['version'] += 1
+        publish(store_dir, manifest)
+        logger.info('Published version %d of %s: %d videos, %d captions',
+                    manifest['version'], store_dir, manifest['num_videos'],
+                    manifest['num_captions'])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.DEBUG, format='%(asctime)s:%(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('store_dir', type=str, help='store directory')
+    parser.add_argument(
+        'captions_json',
+        type=str,
+        help='_proprocessedtokens json file of the new videos')
+    parser.add_argument(
+        '--feat_h5',
+        type=str,
+        nargs='+',
+        required=True,
+        help='features of the new videos, as name=path of a feature h5 file')
+    parser.add_argument(
+        '--vocab_json',
+        type=str,
+        help='vocab json file (only used to create the store)')
+    parser.add_argument(
+        '--max_length',
+        default=30,
+        type=int,
+        help='max length of a caption (only used to create the store)')
+
+    args = parser.parse_args()
+    logger.info('Input parameters: %s', args)
+
+    feat_h5s = dict(f.split('=', 1) for f in args.feat_h5)
+
+    start = datetime.now()
+
+    main(args.store_dir, args.captions_json, feat_h5s, args.vocab_json,
+         args.max_length)
+
+    logger.info('Time: %s', datetime.now() - start)
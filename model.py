@@ -43,10 +43,30 @@ class CrossEntropyCriterion(nn.Module):
         return output
 
 
+def ragged_pool(x, lengths, pooling='mean'):
+    """Masked mean or max over the chunks of each video.
+    x has the chunks of all videos packed together (sum of lengths x F),
+    lengths is the number of chunks of each video (N). Returns N x F.
+    """
+    offsets = torch.cumsum(lengths, 0) - lengths
+    positions = torch.arange(lengths.max().item(), device=x.device)
+    mask = positions.unsqueeze(0) < lengths.unsqueeze(1)
+    index = (offsets.unsqueeze(1) + positions.unsqueeze(0)).clamp(
+        max=x.size(0) - 1)
+    # N x C x F, the positions past the chunks of a video are masked
+    padded = x[index]
+    mask = mask.unsqueeze(2)
+
+    if pooling == 'max':
+        return padded.masked_fill(~mask, float('-inf')).max(1)[0]
+    return (padded * mask.type_as(x)).sum(1) / lengths.unsqueeze(1).type_as(x)
+
+
 class FeatPool(nn.Module):
 
-    def __init__(self, feat_dims, out_size, dropout):
+    def __init__(self, feat_dims, out_size, dropout, pooling='mean'):
         super(FeatPool, self).__init__()
+        self.pooling = pooling
 
         module_list = []
         for dim in feat_dims:
@@ -59,15 +79,37 @@ class FeatPool(nn.Module):
 
     def forward(self, feats):
         """
-        feats is a list, each element is a tensor that have size (N x C x F)
-        at the moment assuming that C == 1
+        feats is a list, each element is a tensor that have size (N x C x F),
+        or a pair (chunks, lengths) for a variable number of chunks per video,
+        see ragged_pool. Each chunk is encoded, then the chunks of each video
+        are pooled.
         """
         out = torch.cat(
-            [m(feats[i].squeeze(1)) for i, m in enumerate(self.feat_list)], 1)
+            [self.pool(m, feats[i]) for i, m in enumerate(self.feat_list)], 1)
         # pdb.set_trace()
         # out = self.embed(torch.cat(feats, 2).squeeze(1))
         return out
 
+    def pool(self, module, feat):
+        if isinstance(feat, (tuple, list)):
+            # only the chunks of the videos are encoded, there is no padding
+            chunks, lengths = feat
+            return ragged_pool(module(chunks), lengths, self.pooling)
+
+        out = module(feat)
+        if self.pooling == 'max':
+            return out.max(1)[0]
+        return out.mean(1)
+
+
+def expand_rows(x, n):
+    """Repeat each row of x (B x D) n times: rows i * n to (i + 1) * n - 1
+    of the output are x[i]. x is only broadcast (no copy) until the single
+    copy that makes the output contiguous.
+    """
+    return x.unsqueeze(1).expand(x.size(0), n, x.size(1)).contiguous().view(
+        x.size(0) * n, x.size(1))
+
 
 class FeatExpander(nn.Module):
 
@@ -77,14 +119,8 @@ class FeatExpander(nn.Module):
 
     def forward(self, x):
         if self.n == 1:
-            out = x
-        else:
-            out = x.new_empty((self.n * x.size(0), x.size(1)))
-
-            for i in range(x.size(0)):
-                out[i * self.n:(i + 1) * self.n] = x[i].expand(
-                    self.n, x.size(1))
-        return out
+            return x
+        return expand_rows(x, self.n)
 
     def set_n(self, x):
         self.n = x
@@ -115,6 +151,18 @@ class RNNUnit(nn.Module):
         output, state = self.rnn(xt.unsqueeze(0), state)
         return output.squeeze(0), state
 
+    def forward_seq(self, x, lengths, state):
+        """Run the whole input sequence x (L x N x input_size) at once,
+        sequence i only for its first lengths[i] steps.
+        Returns the outputs (L x N x rnn_size, 0 past the lengths)
+        """
+        packed = nn.utils.rnn.pack_padded_sequence(
+            x, lengths.cpu(), enforce_sorted=False)
+        output, _ = self.rnn(packed, state)
+        output, _ = nn.utils.rnn.pad_packed_sequence(
+            output, total_length=x.size(0))
+        return output
+
 
 class MANet(nn.Module):
     """
@@ -170,7 +218,8 @@ class CaptionModel(nn.Module):
 
         self.init_weights()
         self.feat_pool = FeatPool(
-            self.feat_dims, self.num_layers * self.rnn_size, self.drop_prob_lm)
+            self.feat_dims, self.num_layers * self.rnn_size, self.drop_prob_lm,
+            getattr(opt, 'chunk_pooling', 'mean'))
         self.feat_expander = FeatExpander(self.seq_per_img)
 
         self.video_encoding_size = self.num_feats * self.num_layers * self.rnn_size
@@ -220,6 +269,9 @@ class CaptionModel(nn.Module):
         fc_feats = self.feat_pool(feats)
         fc_feats = self.feat_expander(fc_feats)
 
+        if self.teacher_forcing():
+            return self.forward_seq(fc_feats, seq)
+
         batch_size = fc_feats.size(0)
         state = self.init_hidden(batch_size)
         outputs = []
@@ -288,6 +340,84 @@ class CaptionModel(nn.Module):
                 torch.cat([_.unsqueeze(1) for _ in sample_seq], 1), \
                 torch.cat([_.unsqueeze(1) for _ in sample_logprobs], 1) \
 
+    def teacher_forcing(self):
+        """The inputs of all steps are the label words: no scheduled sampling
+        or MIXER (manet needs the state of each step)
+        """
+        return self.model_type != 'manet' and not (self.training and (
+            self.ss_prob > 0.0 or self.mixer_from > 0))
+
+    def forward_seq(self, fc_feats, seq):
+        """
+        Teacher forcing over the whole sequence at once: the RNN runs once on
+        the embedded labels, the logits are computed for all steps together.
+        Same outputs as the step-wise loop of forward, except past the
+        <eos> token of each caption (where the RNN does not run).
+        """
+        output, sample_seq = self.rnn_seq(fc_feats, seq)
+
+        outputs = F.log_softmax(self.logit(self.dropout(output)), dim=-1)
+        sample_logprobs = outputs[:, :sample_seq.size(1)].gather(
+            2, sample_seq.unsqueeze(2)).squeeze(2)
+
+        return outputs, sample_seq, sample_logprobs
+
+    def xe_loss(self, feats, seq, mask):
+        """
+        Masked cross-entropy of the labels seq (same loss as
+        CrossEntropyCriterion on the outputs of forward). With teacher
+        forcing, the logits are only computed at the positions of the mask,
+        and the B x L x V log-probabilities are never built.
+        """
+        if not self.teacher_forcing():
+            pred = self.forward(feats, seq)[0]
+            return CrossEntropyCriterion()(pred, seq[:, 1:], mask[:, 1:])
+
+        fc_feats = self.feat_pool(feats)
+        fc_feats = self.feat_expander(fc_feats)
+        output, _ = self.rnn_seq(fc_feats, seq)
+
+        seq_len = output.size(1)
+        positions = mask[:, 1:seq_len + 1] > 0
+        logits = self.logit(self.dropout(output[positions]))
+        return F.cross_entropy(logits, seq[:, 1:seq_len + 1][positions])
+
+    def rnn_seq(self, fc_feats, seq):
+        """
+        Run the RNN on the whole label sequence seq.
+        Returns the outputs of the RNN (B x L x rnn_size) for the same L
+        steps as the step-wise loop of forward, and the words it samples
+        """
+        # the step-wise loop stops at the first column of <eos> tokens
+        end_i = seq.size(1) - 1
+        ended = (seq[:, 1:end_i] != 0).sum(0) == 0
+        if ended.any():
+            seq_len = ended.nonzero()[0].item() + 1
+            sample_seq = seq[:, 1:seq_len + 1]
+        else:
+            seq_len = end_i
+            sample_seq = seq[:, 1:seq_len]
+
+        xt = self.embed(seq[:, :seq_len]).transpose(0, 1)
+        # inputs: <bos> and the words of each caption
+        lengths = (seq[:, :seq_len] != 0).sum(1)
+        if self.model_type == 'standard':
+            xt = torch.cat([fc_feats.unsqueeze(0), xt], 0)
+            lengths = lengths + 1
+        else:
+            xt = torch.cat([
+                xt,
+                fc_feats.unsqueeze(0).expand(seq_len, fc_feats.size(0),
+                                             fc_feats.size(1))
+            ], 2)
+
+        state = self.init_hidden(fc_feats.size(0))
+        output = self.core.forward_seq(xt, lengths, state)
+        if self.model_type == 'standard':
+            output = output[1:]
+
+        return output.transpose(0, 1), sample_seq
+
     def sample(self, feats, opt={}):
         sample_max = opt.get('sample_max', 1)
         beam_size = opt.get('beam_size', 1)
@@ -334,7 +464,7 @@ class CaptionModel(nn.Module):
                         prob_prev = torch.exp(
                             torch.div(logprobs.detach(), temperature)).cpu()
                     #import pdb; pdb.set_trace()
-                    it = torch.multinomial(prob_prev, 1).cuda()
+                    it = torch.multinomial(prob_prev, 1).to(logprobs.device)
                     # gather the logprobs at sampled positions
                     sampleLogprobs = logprobs.gather(1, it)
                     # and flatten indices for downstream processing
@@ -369,144 +499,112 @@ class CaptionModel(nn.Module):
     def sample_beam(self, feats, opt={}):
         """
         modified from https://github.com/ruotianluo/self-critical.pytorch
+        All videos of the batch are decoded at once, with beam_size beams
+        each (rows k * beam_size to (k + 1) * beam_size - 1 are video k).
+        A beam that emits the END token (or reaches the end) gives a finished
+        caption, the one with the lowest perplexity is returned per video.
         """
         beam_size = opt.get('beam_size', 5)
         fc_feats = self.feat_pool(feats)
         batch_size = fc_feats.size(0)
+        fc_feats = expand_rows(fc_feats, beam_size)
+        state = self.init_hidden(batch_size * beam_size)
+
+        beam_seq = fc_feats.new_zeros(
+            (batch_size, beam_size, self.seq_length), dtype=torch.long)
+        beam_seq_logprobs = fc_feats.new_zeros(
+            (batch_size, beam_size, self.seq_length))
+        # running sum of logprobs for each beam
+        beam_logprobs_sum = fc_feats.new_zeros((batch_size, beam_size))
+        # first row of the beams of each video
+        beam_offsets = torch.arange(
+            batch_size, device=fc_feats.device).unsqueeze(1) * beam_size
+
+        # best finished caption of each video
+        done_seq = beam_seq.new_zeros((batch_size, self.seq_length))
+        done_logprobs = beam_seq_logprobs.new_zeros(
+            (batch_size, self.seq_length))
+        done_ppl = fc_feats.new_full((batch_size, ), float('inf'))
 
-        seq = torch.zeros((self.seq_length, batch_size), dtype=torch.long)
-        seqLogprobs = torch.FloatTensor(self.seq_length, batch_size)
-        # lets process every image independently for now, for simplicity
-
-        self.done_beams = [[] for _ in range(batch_size)]
-        for k in range(batch_size):
-            state = self.init_hidden(beam_size)
-            fc_feats_k = fc_feats[k].expand(beam_size, self.video_encoding_size)
-
-            beam_seq = torch.zeros(
-                (self.seq_length, beam_size), dtype=torch.long)
-            beam_seq_logprobs = torch.zeros(self.seq_length, beam_size)
-            # running sum of logprobs for each beam
-            beam_logprobs_sum = torch.zeros(beam_size)
-
-            # -- if <image feature> is input at the first step, use index -1
-            start_i = -1 if self.model_type == 'standard' else 0
-            end_i = self.seq_length - 1
-
-            for token_idx in range(start_i, end_i):
-                if token_idx == -1:
-                    xt = fc_feats_k
-                elif token_idx == 0:  # input <bos>
-                    it = fc_feats.new_full(
-                        [
-                            beam_size,
-                        ], self.bos_index, dtype=torch.long)
-                    xt = self.embed(it)
-                else:
-                    """perform a beam merge. that is,
-                    for every previous beam we now many new possibilities to branch out
-                    we need to resort our beams to maintain the loop invariant of keeping
-                    the top beam_size most likely sequences."""
-                    logprobsf = logprobs.float().cpu()
-                    # lets go to CPU for more efficiency in indexing operations
-                    # sorted array of logprobs along each previous beam (last
-                    # true = descending)
-                    ys, ix = torch.sort(logprobsf, 1, True)
-                    candidates = []
-                    cols = min(beam_size, ys.size(1))
-                    rows = beam_size
-                    if token_idx == 1:  # at first time step only the first beam is active
-                        rows = 1
-                    for c in range(cols):
-                        for q in range(rows):
-                            # compute logprob of expanding beam q with word in
-                            # (sorted) position c
-                            local_logprob = ys[q, c]
-                            candidate_logprob = beam_logprobs_sum[q] + local_logprob
-                            candidates.append({
-                                'c': ix[q, c],
-                                'q': q,
-                                'p': candidate_logprob.item(),
-                                'r': local_logprob.item()
-                            })
-                    candidates = sorted(candidates, key=lambda x: -x['p'])
-
-                    # construct new beams
-                    new_state = [_.clone() for _ in state]
-                    if token_idx > 1:
-                        # well need these as reference when we fork beams
-                        # around
-                        beam_seq_prev = beam_seq[:token_idx - 1].clone()
-                        beam_seq_logprobs_prev = beam_seq_logprobs[:token_idx -
-                                                                   1].clone()
-
-                    for vix in range(beam_size):
-                        v = candidates[vix]
-                        # fork beam index q into index vix
-                        if token_idx > 1:
-                            beam_seq[:token_idx - 1, vix] = beam_seq_prev[:, v[
-                                'q']]
-                            beam_seq_logprobs[:token_idx - 1,
-                                              vix] = beam_seq_logprobs_prev[:, v[
-                                                  'q']]
-
-                        # rearrange recurrent states
-                        for state_ix in range(len(new_state)):
-                            # copy over state in previous beam q to new beam at
-                            # vix
-                            new_state[state_ix][0, vix] = state[state_ix][0, v[
-                                'q']]  # dimension one is time step
-
-                        # append new end terminal at the end of this beam
-                        # c'th word is the continuation
-                        beam_seq[token_idx - 1, vix] = v['c']
-                        beam_seq_logprobs[token_idx - 1, vix] = v[
-                            'r']  # the raw logprob here
-                        # the new (sum) logprob along this beam
-                        beam_logprobs_sum[vix] = v['p']
-
-                        if v['c'] == 0 or token_idx == self.seq_length - 2:
-                            # END token special case here, or we reached the end.
-                            # add the beam to a set of done beams
-                            if token_idx > 1:
-                                ppl = np.exp(-beam_logprobs_sum[vix] /
-                                             (token_idx - 1))
-                            else:
-                                ppl = 10000
-                            self.done_beams[k].append({
-                                'seq':
-                                beam_seq[:, vix].clone(),
-                                'logps':
-                                beam_seq_logprobs[:, vix].clone(),
-                                'p':
-                                beam_logprobs_sum[vix],
-                                'ppl':
-                                ppl
-                            })
-
-                    # encode as vectors
-                    it = beam_seq[token_idx - 1]
-                    xt = self.embed(it.cuda())
-
-                if token_idx >= 1:
-                    state = new_state
+        # -- if <image feature> is input at the first step, use index -1
+        start_i = -1 if self.model_type == 'standard' else 0
+        end_i = self.seq_length - 1
 
-                if self.model_type == 'standard':
-                    output, state = self.core(xt, state)
+        for token_idx in range(start_i, end_i):
+            if token_idx == -1:
+                xt = fc_feats
+            elif token_idx == 0:  # input <bos>
+                it = fc_feats.new_full(
+                    [
+                        batch_size * beam_size,
+                    ], self.bos_index, dtype=torch.long)
+                xt = self.embed(it)
+            else:
+                """perform a beam merge. that is,
+                for every previous beam we now many new possibilities to branch out
+                we need to resort our beams to maintain the loop invariant of keeping
+                the top beam_size most likely sequences."""
+                logprobs = logprobs.view(batch_size, beam_size, -1)
+                vocab_size = logprobs.size(2)
+                candidate_logprobs = beam_logprobs_sum.unsqueeze(2) + logprobs
+                if token_idx == 1:
+                    # at first time step only the first beam is active
+                    candidate_logprobs[:, 1:] = float('-inf')
+
+                # top beam_size candidates over (beam, word) of each video
+                beam_logprobs_sum, ix = candidate_logprobs.view(
+                    batch_size, -1).topk(beam_size, 1)
+                local_logprobs = logprobs.view(batch_size, -1).gather(1, ix)
+                prev_beam = ix // vocab_size
+                it = ix % vocab_size
+
+                # fork the beams: copy over the captions and the recurrent
+                # states of the previous beams
+                prev_rows = (beam_offsets + prev_beam).view(-1)
+                beam_seq = beam_seq.view(batch_size * beam_size, -1).index_select(
+                    0, prev_rows).view(batch_size, beam_size, -1)
+                beam_seq_logprobs = beam_seq_logprobs.view(
+                    batch_size * beam_size, -1).index_select(
+                        0, prev_rows).view(batch_size, beam_size, -1)
+                if self.rnn_type == 'lstm':
+                    state = tuple(_.index_select(1, prev_rows) for _ in state)
                 else:
-                    if self.model_type == 'manet':
-                        fc_feats_k = self.manet(fc_feats_k, state[0])
-                    output, state = self.core(
-                        torch.cat([xt, fc_feats_k], 1), state)
-
-                logprobs = F.log_softmax(self.logit(output), dim=-1)
+                    state = state.index_select(1, prev_rows)
+
+                # append the new words at the end of the beams
+                beam_seq[:, :, token_idx - 1] = it
+                beam_seq_logprobs[:, :, token_idx - 1] = local_logprobs
+
+                # END token special case here, or we reached the end.
+                # keep the finished beam if it has the lowest perplexity so
+                # far (the earliest one if tied)
+                done = it == 0
+                if token_idx == self.seq_length - 2:
+                    done = torch.ones_like(done)
+                if token_idx > 1:
+                    ppl = torch.exp(-beam_logprobs_sum / (token_idx - 1))
+                else:
+                    ppl = torch.full_like(beam_logprobs_sum, 10000)
+                ppl = ppl.masked_fill(~done, float('inf'))
+                step_ppl, step_beam = ppl.min(1)
+                better = step_ppl < done_ppl
+                done_ppl = torch.where(better, step_ppl, done_ppl)
+                step_rows = beam_offsets.view(-1) + step_beam
+                done_seq[better] = beam_seq.view(
+                    batch_size * beam_size, -1)[step_rows][better]
+                done_logprobs[better] = beam_seq_logprobs.view(
+                    batch_size * beam_size, -1)[step_rows][better]
+
+                # encode as vectors
+                xt = self.embed(it.view(-1))
 
-            #self.done_beams[k] = sorted(self.done_beams[k], key=lambda x: -x['p'])
-            self.done_beams[k] = sorted(
-                self.done_beams[k], key=lambda x: x['ppl'])
+            if self.model_type == 'standard':
+                output, state = self.core(xt, state)
+            else:
+                if self.model_type == 'manet':
+                    fc_feats = self.manet(fc_feats, state[0])
+                output, state = self.core(torch.cat([xt, fc_feats], 1), state)
 
-            # the first beam has highest cumulative score
-            seq[:, k] = self.done_beams[k][0]['seq']
-            seqLogprobs[:, k] = self.done_beams[k][0]['logps']
+            logprobs = F.log_softmax(self.logit(output), dim=-1)
 
-        return seq.transpose(0, 1), seqLogprobs.transpose(0, 1)
+        return done_seq, done_logprobs
@@ -8,7 +8,8 @@ def parse_opts():
     parser.add_argument(
         '--train_label_h5',
         type=str,
-        help='path to the h5file containing the preprocessed dataset')
+        nargs='+',
+        help='path to the h5file containing the preprocessed dataset, or to a store of ingest_videos.py (several files: train on a mixture of datasets)')
     parser.add_argument(
         '--val_label_h5',
         type=str,
@@ -22,7 +23,7 @@ def parse_opts():
         '--train_feat_h5',
         type=str,
         nargs='+',
-        help='path to the h5 file containing extracted features')
+        help='path to the h5 file containing extracted features (for a mixture, the feature files of each dataset in turn)')
     parser.add_argument(
         '--val_feat_h5',
         type=str,
@@ -50,7 +51,17 @@ def parse_opts():
     parser.add_argument(
         '--train_bcmrscores_pkl',
         type=str,
-        help='Pre-computed Cider-D metric for all captions')
+        nargs='+',
+        help='Pre-computed Cider-D metric for all captions (pkl file, or directory written by compute_scores.py --output_dir), one per training dataset')
+    parser.add_argument(
+        '--mixture_weights',
+        type=float,
+        nargs='+',
+        help='Sampling weight of each training dataset of a mixture (default: uniform)')
+    parser.add_argument(
+        '--mixture_vocab',
+        type=str,
+        help='Vocab json file shared by the datasets of a mixture (default: the vocab of the first dataset)')
     
     # Optimization: General
     parser.add_argument(
@@ -238,11 +249,102 @@ def parse_opts():
         type=int,
         default=7,
         help='which gpu to use. -1 = use CPU')
+    parser.add_argument(
+        '--device',
+        type=str,
+        default='auto',
+        help='Device of the model: cpu, cuda, cuda:<index>, or auto (cuda if available, else cpu)')
+    parser.add_argument(
+        '--num_threads',
+        type=int,
+        default=0,
+        help='Number of CPU threads of the model operations (intra-op). 0 = PyTorch default')
+    parser.add_argument(
+        '--num_interop_threads',
+        type=int,
+        default=0,
+        help='Number of CPU threads running independent operations (inter-op). 0 = PyTorch default')
     parser.add_argument(
         '--num_chunks',
         type=int,
         default=1,
         help='1: no attention, > 1: attention with num_chunks')
+    parser.add_argument(
+        '--chunk_pooling',
+        type=str,
+        default='mean',
+        choices=['mean', 'max'],
+        help='Pooling of the encoded chunks of each video')
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=0,
+        help='Number of batches to assemble in a background thread. 0 = disable prefetching')
+    parser.add_argument(
+        '--bulk_read',
+        type=int,
+        default=1,
+        help='1: read the features of a batch file by file in storage order, 0: read video by video')
+    parser.add_argument(
+        '--num_buffers',
+        type=int,
+        default=0,
+        help='Number of preallocated batch buffers reused by the loader (at least prefetch + 2). 0 = allocate every batch')
+    parser.add_argument(
+        '--share_buffers',
+        type=int,
+        default=0,
+        help='1: allocate the batch buffers in shared memory (needs --num_buffers > 0)')
+    parser.add_argument(
+        '--feat_cache_mb',
+        type=int,
+        default=0,
+        help='Size in MB of the LRU cache of h5 features of the val/test loaders. 0 = no cache')
+    parser.add_argument(
+        '--chunk_cache_mb',
+        type=float,
+        nargs='+',
+        help='Size in MB of the raw data chunk cache of each h5 feature file (one value, or one per feature type, in the order of the feature files of a dataset). Default: h5py default (1 MB)')
+    parser.add_argument(
+        '--chunk_cache_slots',
+        type=int,
+        nargs='+',
+        help='Number of hash slots of the chunk cache of each h5 feature file (one value, or one per feature type), ideally a prime about 100 times the number of chunks that fit in the cache')
+    parser.add_argument(
+        '--chunk_cache_w0',
+        type=float,
+        nargs='+',
+        help='Chunk preemption policy of each h5 feature file (one value, or one per feature type), between 0 and 1 (1: evict first the chunks that were fully read)')
+    parser.add_argument(
+        '--shm_cache',
+        type=int,
+        default=0,
+        help='1: share the h5 features between the jobs of a node through /dev/shm (the first job copies them, the others attach)')
+    parser.add_argument(
+        '--rank',
+        type=int,
+        default=0,
+        help='Rank of this process when training with several processes over one dataset')
+    parser.add_argument(
+        '--world_size',
+        type=int,
+        default=1,
+        help='Number of training processes. Each one loads a disjoint shard of the training videos per epoch')
+    parser.add_argument(
+        '--length_bucketing',
+        type=int,
+        default=0,
+        help='1: batch together training videos with similar caption lengths to reduce the RNN steps')
+    parser.add_argument(
+        '--block_size',
+        type=int,
+        default=0,
+        help='> 0: shuffle training videos by blocks of this many videos in storage order (for slow random reads). 0 = full shuffle')
+    parser.add_argument(
+        '--block_window',
+        type=int,
+        default=4,
+        help='Number of consecutive shuffled blocks whose videos are shuffled together')
     parser.add_argument(
         '--num_layers',
         type=int,
@@ -287,6 +389,12 @@ def parse_opts():
         default=30.0,
         help='plot k/(k+exp(x/k)) from x=0 to 400, k=30')
 
+    parser.add_argument(
+        '--fused_xe',
+        type=int,
+        default=1,
+        help='Compute the cross-entropy loss from the logits of the caption words only (without the log-probabilities of all words at all steps). Only with teacher forcing, and not at test time with --output_logp 1')
+
     parser.add_argument(
         '--use_mixer',
         type=int,
@@ -342,4 +450,20 @@ def parse_opts():
     
     
     args = parser.parse_args()
+
+    # the chunk cache options have one value per feature type, i.e. per
+    # feature file of a dataset (train_feat_h5 has those of each dataset of
+    # a mixture in turn)
+    feat_h5 = args.test_feat_h5 or args.val_feat_h5
+    if feat_h5:
+        num_feats = len(feat_h5)
+    elif args.train_feat_h5 and args.train_label_h5:
+        num_feats = len(args.train_feat_h5) // len(args.train_label_h5)
+    else:
+        num_feats = None
+    for key in ['chunk_cache_mb', 'chunk_cache_slots', 'chunk_cache_w0']:
+        values = getattr(args, key)
+        if values and num_feats and len(values) not in [1, num_feats]:
+            parser.error('--{} needs one value, or one per feature type ({})'.
+                         format(key, num_feats))
     return args
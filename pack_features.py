@@ -0,0 +1,106 @@
+"""
+Pack the per-video features of a feature h5 file into one contiguous
+(num_videos x dim) array, with rows in the order of the videos of a label h5
+file. The array is saved as .npy so that the DataLoader can memory-map it,
+the video ids of the rows are saved next to it (see packed_videos_file).
+
+With --ragged, videos can have different numbers of chunks (C x dim): the
+chunks of all videos are packed into one (total chunks x dim) array, and the
+offset of the first chunk of each video is saved next to it (see
+packed_offsets_file), so that short videos are not padded.
+"""
+
+import json
+import argparse
+import h5py
+import numpy as np
+
+import logging
+from datetime import datetime
+
+from dataloader import packed_videos_file, packed_scale_file, packed_offsets_file
+
+logger = logging.getLogger(__name__)
+
+
+def pack_ragged(ff, videos, output_npy):
+    """Pack the chunks of all videos, returns the offsets of their first
+    chunks (and the total number of chunks)
+    """
+    shapes = [ff[video_id].shape for video_id in videos]
+    lengths = np.array([1 if len(s) == 1 else s[0] for s in shapes])
+    assert np.all(lengths > 0), 'videos without chunks'
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    logger.info('Packing %d chunks of %d videos (%d to %d per video)',
+                offsets[-1], len(videos), lengths.min(), lengths.max())
+
+    out = np.lib.format.open_memmap(
+        output_npy,
+        mode='w+',
+        dtype=ff[videos[0]].dtype,
+        shape=(int(offsets[-1]), shapes[0][-1]))
+    for i, video_id in enumerate(videos):
+        ff[video_id].read_direct(out[offsets[i]:offsets[i + 1]].reshape(
+            shapes[i]))
+        if i % 1000 == 0:
+            logger.info('Packed %d/%d videos', i, len(videos))
+    out.flush()
+    del out
+    return offsets
+
+
+def main(label_h5, feat_h5, output_npy, ragged=False):
+
+    logger.info('Loading videos from: %s', label_h5)
+    with h5py.File(label_h5, 'r') as lf:
+        videos = [i.decode() for i in lf['videos']]
+
+    with h5py.File(feat_h5, 'r') as ff:
+        if ragged:
+            offsets = pack_ragged(ff, videos, output_npy)
+            np.save(packed_offsets_file(output_npy), offsets)
+        else:
+            shape = ff[videos[0]].shape
+            dtype = ff[videos[0]].dtype
+            logger.info('Packing %d videos of shape %s (%s)', len(videos),
+                        shape, dtype)
+
+            out = np.lib.format.open_memmap(
+                output_npy, mode='w+', dtype=dtype, shape=(len(videos),) + shape)
+            for i, video_id in enumerate(videos):
+                ff[video_id].read_direct(out[i])
+                if i % 1000 == 0:
+                    logger.info('Packed %d/%d videos', i, len(videos))
+            out.flush()
+            del out
+
+        if 'scale' in ff.attrs:
+            # int8 features, see quantize_features.py
+            np.save(packed_scale_file(output_npy), ff.attrs['scale'])
+
+    json.dump(videos, open(packed_videos_file(output_npy), 'w'))
+    logger.info('Wrote to %s', output_npy)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.DEBUG, format='%(asctime)s:%(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        'label_h5', type=str, help='_sequencelabel.h5 file (defines the row order)')
+    parser.add_argument('feat_h5', type=str, help='feature h5 file')
+    parser.add_argument('output_npy', type=str, help='output packed .npy file')
+    parser.add_argument(
+        '--ragged',
+        action='store_true',
+        help='pack a variable number of chunks per video, without padding')
+
+    args = parser.parse_args()
+    logger.info('Input parameters: %s', args)
+
+    start = datetime.now()
+
+    main(args.label_h5, args.feat_h5, args.output_npy, args.ragged)
+
+    logger.info('Time: %s', datetime.now() - start)
@@ -0,0 +1,89 @@
+"""
+Rewrite a feature h5 file with reduced precision, either as float16 or as
+int8 with a per-dimension scale (x ~= q * scale, stored in the 'scale'
+attribute of the file). The DataLoader dequantizes them to float32.
+The reconstruction error is reported and saved in the file attributes.
+"""
+
+import argparse
+import h5py
+import numpy as np
+
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def compute_scale(ff, videos):
+    """Symmetric per-dimension scale mapping the max absolute value to 127"""
+    max_abs = 0
+    for video_id in videos:
+        feat = np.abs(np.array(ff[video_id], dtype=np.float32))
+        max_abs = np.maximum(max_abs, feat.reshape(-1, feat.shape[-1]).max(0))
+    max_abs[max_abs == 0] = 1
+    return (max_abs / 127).astype(np.float32)
+
+
+def main(feat_h5, output_h5, dtype):
+
+    with h5py.File(feat_h5, 'r') as ff, h5py.File(output_h5, 'w') as of:
+        videos = list(ff.keys())
+        logger.info('Quantizing %d videos to %s', len(videos), dtype)
+
+        if dtype == 'int8':
+            scale = compute_scale(ff, videos)
+            of.attrs['scale'] = scale
+
+        err_sq = 0.
+        ref_sq = 0.
+        max_err = 0.
+        for i, video_id in enumerate(videos):
+            feat = np.array(ff[video_id], dtype=np.float32)
+            if dtype == 'int8':
+                q = np.clip(np.round(feat / scale), -127, 127).astype(np.int8)
+                rec = q * scale
+            else:
+                q = feat.astype(np.float16)
+                rec = q.astype(np.float32)
+            of.create_dataset(video_id, data=q)
+
+            err = rec - feat
+            err_sq += np.sum(err**2)
+            ref_sq += np.sum(feat**2)
+            max_err = max(max_err, np.abs(err).max())
+            if i % 1000 == 0:
+                logger.info('Quantized %d/%d videos', i, len(videos))
+
+        rel_err = np.sqrt(err_sq / max(ref_sq, 1e-12))
+        of.attrs['quantization'] = dtype
+        of.attrs['relative_error'] = rel_err
+        of.attrs['max_abs_error'] = max_err
+        logger.info('Reconstruction error: relative (L2) %f, max abs %f',
+                    rel_err, max_err)
+
+    logger.info('Wrote to %s', output_h5)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.DEBUG, format='%(asctime)s:%(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('feat_h5', type=str, help='feature h5 file')
+    parser.add_argument('output_h5', type=str, help='output feature h5 file')
+    parser.add_argument(
+        '--dtype',
+        type=str,
+        default='float16',
+        choices=['float16', 'int8'],
+        help='storage type of the features')
+
+    args = parser.parse_args()
+    logger.info('Input parameters: %s', args)
+
+    start = datetime.now()
+
+    main(args.feat_h5, args.output_h5, args.dtype)
+
+    logger.info('Time: %s', datetime.now() - start)
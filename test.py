@@ -12,7 +12,7 @@ from datetime import datetime
 
 from dataloader import DataLoader
 from model import CaptionModel, CrossEntropyCriterion
-from train import test
+from train import test, setup_device
 
 import utils
 import opts
@@ -33,29 +33,44 @@ if __name__ == '__main__':
             sort_keys=True,
             indent=4))
 
+    device = setup_device(opt)
     start = datetime.now()
 
+    logger.info('Loading model: %s', opt.model_file)
+    # written by train.py, it has the infos and opt of the training
+    checkpoint = torch.load(
+        opt.model_file, map_location='cpu', weights_only=False)
+    checkpoint_opt = checkpoint['opt']
+
+    opt.model_type = checkpoint_opt.model_type
+    opt.vocab = checkpoint_opt.vocab
+    opt.vocab_size = checkpoint_opt.vocab_size
+    opt.seq_length = checkpoint_opt.seq_length
+    opt.feat_dims = checkpoint_opt.feat_dims
+    opt.chunk_pooling = getattr(checkpoint_opt, 'chunk_pooling', 'mean')
+
     test_opt = {'label_h5': opt.test_label_h5,
                 'batch_size': opt.test_batch_size,
                 'feat_h5': opt.test_feat_h5,
                 'cocofmt_file': opt.test_cocofmt_file,
                 'seq_per_img': opt.test_seq_per_img,
                 'num_chunks': opt.num_chunks,
+                'prefetch': opt.prefetch,
+                'bulk_read': opt.bulk_read,
+                'num_buffers': opt.num_buffers,
+                'share_buffers': opt.share_buffers,
+                'feat_cache_mb': opt.feat_cache_mb,
+                'chunk_cache_mb': opt.chunk_cache_mb,
+                'chunk_cache_slots': opt.chunk_cache_slots,
+                'chunk_cache_w0': opt.chunk_cache_w0,
+                'exact_final_batch': 1,
+                'seed': opt.seed,
+                'vocab': [opt.vocab[i] for i in range(opt.vocab_size)],
                 'mode': 'test'
                 }
 
     test_loader = DataLoader(test_opt)
 
-    logger.info('Loading model: %s', opt.model_file)
-    checkpoint = torch.load(opt.model_file)
-    checkpoint_opt = checkpoint['opt']
-
-    opt.model_type = checkpoint_opt.model_type
-    opt.vocab = checkpoint_opt.vocab
-    opt.vocab_size = checkpoint_opt.vocab_size
-    opt.seq_length = checkpoint_opt.seq_length
-    opt.feat_dims = checkpoint_opt.feat_dims
-
 
     assert opt.vocab_size == test_loader.get_vocab_size()
     assert opt.seq_length == test_loader.get_seq_length()
@@ -68,8 +83,8 @@ if __name__ == '__main__':
 
     xe_criterion = CrossEntropyCriterion()
 
-    model.cuda()
-    xe_criterion.cuda()
+    model.to(device)
+    xe_criterion.to(device)
 
     logger.info('Start testing...')
     test(model, xe_criterion, test_loader, opt)
@@ -11,9 +11,11 @@ import json
 import uuid
 import logging
 import pickle
+import random
+import signal
 from datetime import datetime
 
-from dataloader import DataLoader
+from dataloader import DataLoader, MixtureLoader
 from model import CaptionModel, CrossEntropyCriterion, RewardCriterion
 
 import utils
@@ -42,6 +44,92 @@ def language_eval(predictions, cocofmt_file, opt):
     return lang_stats
 
 
+def feats_to_device(feats, device):
+    """Move the features of a batch to the device of the model, ragged
+    features are (chunks, lengths) pairs
+    """
+    return [
+        tuple(t.to(device) for t in feat)
+        if isinstance(feat, tuple) else feat.to(device) for feat in feats
+    ]
+
+
+def setup_device(opt):
+    """Resolve the device of the model ('auto': the GPU if there is one) and
+    set the number of CPU threads
+    """
+    if opt.device == 'auto':
+        opt.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if opt.num_threads > 0:
+        torch.set_num_threads(opt.num_threads)
+    if opt.num_interop_threads > 0:
+        torch.set_num_interop_threads(opt.num_interop_threads)
+    logger.info('Device: %s, CPU threads: %d (inter-op: %d)', opt.device,
+                torch.get_num_threads(), torch.get_num_interop_threads())
+    return torch.device(opt.device)
+
+
+def log_io_stats(loader):
+    """Log the reads of each feature file since the last call"""
+    for stats in loader.get_io_stats(reset=True):
+        logger.info('I/O %s: %.1f MB, %d reads, %.3fs (%.1f MB/s)',
+                    stats['file'], stats['bytes'] / 2.**20, stats['calls'],
+                    stats['time'],
+                    stats['bytes'] / 2.**20 / max(stats['time'], 1e-6))
+
+
+def get_rng_state():
+    state = {
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'python': random.getstate()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_resume_checkpoint(model,
+                           optimizer,
+                           train_loader,
+                           val_state,
+                           opt,
+                           infos,
+                           infos_history,
+                           checkpoint_checked,
+                           validating=False):
+    """Save everything needed to continue training from the current iteration,
+    including the position of the train loader and the RNG states (with
+    val_state, the state of the val loader and its caption sampling RNG).
+    validating: saved during the validation of this iteration, which is
+    done again first when resuming.
+    """
+    tmp_resume_file = opt.resume_file + '.tmp'
+    torch.save({
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'infos': infos,
+        'infos_history': infos_history,
+        'checkpoint_checked': checkpoint_checked,
+        'validating': validating,
+        'loader': train_loader.get_state(),
+        'val_loader': val_state,
+        'rng': get_rng_state(),
+        'opt': opt
+    }, tmp_resume_file)
+    # do not leave a partial file if we are killed while writing
+    os.replace(tmp_resume_file, opt.resume_file)
+    logger.info('Wrote resume checkpoint to: %s', opt.resume_file)
+
+
 def train(model,
           criterion,
           optimizer,
@@ -60,11 +148,32 @@ def train(model,
     }
 
     checkpoint_checked = False
+    validating = False
     rl_training = False
     seq_per_img = train_loader.get_seq_per_img()
     infos_history = {}
 
-    if os.path.exists(opt.start_from):
+    if os.path.exists(opt.resume_file):
+        logger.info('Resuming from: %s', opt.resume_file)
+        # written by save_resume_checkpoint, it has RNG states and opt
+        checkpoint = torch.load(
+            opt.resume_file, map_location='cpu', weights_only=False)
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        infos = checkpoint['infos']
+        infos_history = checkpoint['infos_history']
+        checkpoint_checked = checkpoint['checkpoint_checked']
+        validating = checkpoint.get('validating', False)
+        opt.use_rl_after = checkpoint['opt'].use_rl_after
+        opt.use_cst_after = checkpoint['opt'].use_cst_after
+        set_rng_state(checkpoint['rng'])
+        # the RNGs of the loader are restored to their state after the last
+        # consumed batch, which the prefetching thread may have moved past
+        # when the checkpoint was saved
+        train_loader.set_state(checkpoint['loader'])
+        if 'val_loader' in checkpoint:
+            val_loader.set_state(checkpoint['val_loader'])
+    elif os.path.exists(opt.start_from):
         if os.path.isdir(opt.start_from):
             # loading the same model file at a different experiment dir
             start_from_file = os.path.join(opt.start_from,
@@ -72,7 +181,8 @@ def train(model,
         else:
             start_from_file = opt.start_from
         logger.info('Loading state from: %s', start_from_file)
-        checkpoint = torch.load(start_from_file)
+        checkpoint = torch.load(
+            start_from_file, map_location='cpu', weights_only=False)
         model.load_state_dict(checkpoint['model'])
         infos = checkpoint['infos']
         infos['start_epoch'] = infos['epoch']
@@ -97,184 +207,258 @@ def train(model,
         opt.use_cst_after = infos['epoch']
         train_loader.set_current_epoch(infos['epoch'])
 
-    while True:
-        t_start = time.time()
-        model.train()
-        data = train_loader.get_batch()
-        feats = [feat.cuda() for feat in data['feats']]
-        labels = data['labels'].cuda()
-        masks = data['masks'].cuda()
-
-        # implement scheduled sampling
-        opt.ss_prob = 0
-        if opt.use_ss == 1 and infos['epoch'] >= opt.use_ss_after:
-            annealing_prob = opt.ss_k / \
-                (opt.ss_k + np.exp((infos['epoch'] - opt.use_ss_after) / opt.ss_k))
-            opt.ss_prob = min(1 - annealing_prob, opt.ss_max_prob)
-            model.set_ss_prob(opt.ss_prob)
-
-        if opt.use_rl == 1 and infos['epoch'] >= opt.use_rl_after and not rl_training:
-            logger.info('Using RL objective...')
-            rl_training = True
-            bcmr_scorer = {
-                'Bleu_4': Bleu(),
-                'CIDEr': CiderD(df=opt.train_cached_tokens),
-                'METEOR': Meteor(),
-                'ROUGE_L': Rouge()
-            }[opt.eval_metric]
-
-            #logger.info('loading gt refs: %s', train_loader.cocofmt_file)
-            #gt_refs = utils.load_gt_refs(train_loader.cocofmt_file)
-
-        mixer_from = opt.mixer_from
-        if opt.use_mixer == 1 and rl_training:
-            #annealing_mixer = opt.ss_k / \
-            #    (opt.ss_k + np.exp((infos['epoch'] - opt.use_rl_after) / opt.ss_k))
-            #annealing_mixer = int(round(annealing_mixer * opt.seq_length))
-
-            # -1 for annealing
-            if opt.mixer_from == -1:
-                annealing_mixer = opt.seq_length - int(
-                    np.ceil((infos['epoch'] - opt.use_rl_after + 1) /
-                            opt.mixer_descrease_every))
-                mixer_from = max(1, annealing_mixer)
-
-            model.set_mixer_from(mixer_from)
-
-        scb_captions = opt.scb_captions
-        if opt.use_cst == 1 and rl_training:
-            # if opt.use_cst == 1 and opt.ss_k == 0,
-            # then do not using annealing, but the fixed scb_captions provided
-            #annealing_robust = opt.ss_k / \
-            #    (opt.ss_k + np.exp((infos['epoch'] - opt.use_rl_after) / opt.ss_k))
-            #annealing_robust = int(round((1 - annealing_robust) * seq_per_img))
-
-            # do not use robust before fully mixed
-            # if opt.use_mixer == 1 and mixer_from > 1:
-            #    opt.use_cst_after = infos['epoch']
-
-            # if opt.scb_captions is -1, then use the annealing value,
-            # otherwise, use the set value
-            if opt.scb_captions == -1:
-                annealing_robust = int(
-                    np.ceil((infos['epoch'] - opt.use_cst_after + 1) /
-                            opt.cst_increase_every))
-                scb_captions = min(annealing_robust, seq_per_img - 1)
-
-        optimizer.zero_grad()
-        model.set_seq_per_img(seq_per_img)
-
-        if rl_training:
-            # sampling from model distribution
-            # model_res, logprobs = model.sample(
-            #    feats, {'sample_max': 0, 'expand_feat': opt.expand_feat, 'temperature': 1})
-
-            # using mixer
-            pred, model_res, logprobs = model(feats, labels)
-
-            if opt.use_cst == 0:
-                # greedy decoding baseline in SCST paper
-                greedy_baseline, _ = model.sample(feats, {
-                    'sample_max': 1,
-                    'expand_feat': opt.expand_feat
-                })
-
-            if opt.use_cst == 1:
-                bcmrscores = data['bcmrscores']
-                reward, m_score, g_score = utils.get_cst_reward(
-                    model_res.cpu().numpy(),
-                    data['gts'],
-                    bcmr_scorer,
-                    bcmrscores=bcmrscores,
-                    expand_feat=opt.expand_feat,
-                    seq_per_img=train_loader.get_seq_per_img(),
-                    scb_captions=scb_captions,
-                    scb_baseline=opt.scb_baseline,
-                    use_eos=opt.use_eos,
-                    use_mixer=opt.use_mixer)
-            else:
-                # use greedy baseline by default, compute self-critical reward
-                reward, m_score, g_score = utils.get_self_critical_reward(
-                    model_res.cpu().numpy(),
-                    greedy_baseline.cpu().numpy(),
-                    data['gts'],
-                    bcmr_scorer,
-                    expand_feat=opt.expand_feat,
-                    seq_per_img=train_loader.get_seq_per_img(),
-                    use_eos=opt.use_eos)
-
-            loss = rl_criterion(
-                model_res,
-                logprobs,
-                torch.from_numpy(reward).float().cuda(),
-            )
+    # SIGTERM: write a resume checkpoint and stop, SIGUSR1: write it and go on.
+    # The checkpoint is written at the end of the current iteration, or of
+    # the current batch of a validation (which is then done again first when
+    # resuming). The previous handlers are restored when training ends.
+    received_signals = []
+
+    def handle_signal(signum, frame):
+        logger.info('Received signal %d', signum)
+        received_signals.append(signum)
+
+    def check_signals(val_state=None):
+        """Write the resume checkpoint if a signal was received, and stop on
+        SIGTERM. val_state is the state of the val loader before the
+        validation in progress, if any.
+        """
+        if not received_signals:
+            return
+        save_resume_checkpoint(
+            model,
+            optimizer,
+            train_loader,
+            val_state or val_loader.get_state(),
+            opt,
+            infos,
+            infos_history,
+            checkpoint_checked,
+            validating=val_state is not None)
+        if signal.SIGTERM in received_signals:
+            logger.info('>>> Terminating on SIGTERM...')
+            sys.exit(128 + signal.SIGTERM)
+        del received_signals[:]
+
+    def run_validation():
+        nonlocal checkpoint_checked
+        # evaluate the validation performance
+        val_state = val_loader.get_state()
+        results = validate(
+            model,
+            criterion,
+            val_loader,
+            opt,
+            check_signals=lambda: check_signals(val_state))
+        logger.info('Validation output: %s',
+                    json.dumps(results['scores'], indent=4, sort_keys=True))
+        infos.update(results['scores'])
+
+        check_model(model, opt, infos, infos_history)
+        checkpoint_checked = True
+        save_resume_checkpoint(model, optimizer, train_loader,
+                               val_loader.get_state(), opt, infos,
+                               infos_history, checkpoint_checked)
+
+    previous_handlers = {
+        signum: signal.signal(signum, handle_signal)
+        for signum in [signal.SIGTERM, signal.SIGUSR1]
+    }
 
-        else:
-            pred = model(feats, labels)[0]
-            loss = criterion(pred, labels[:, 1:], masks[:, 1:])
+    def finished():
+        if (infos['epoch'] >= opt.max_epochs or
+                infos['epoch'] - infos['best_epoch'] > opt.max_patience):
+            logger.info('>>> Terminating...')
+            return True
+        return False
+
+    try:
+        stop = False
+        if validating:
+            # interrupted during the validation of the last iteration
+            run_validation()
+            check_signals()
+            stop = finished()
+
+        while not stop:
+            t_start = time.time()
+            model.train()
+            data = train_loader.get_batch()
+            feats = feats_to_device(data['feats'], opt.device)
+            labels = data['labels'].to(opt.device)
+            masks = data['masks'].to(opt.device)
+
+            # implement scheduled sampling
+            opt.ss_prob = 0
+            if opt.use_ss == 1 and infos['epoch'] >= opt.use_ss_after:
+                annealing_prob = opt.ss_k / \
+                    (opt.ss_k + np.exp((infos['epoch'] - opt.use_ss_after) / opt.ss_k))
+                opt.ss_prob = min(1 - annealing_prob, opt.ss_max_prob)
+                model.set_ss_prob(opt.ss_prob)
+
+            if opt.use_rl == 1 and infos['epoch'] >= opt.use_rl_after and not rl_training:
+                logger.info('Using RL objective...')
+                rl_training = True
+                bcmr_scorer = {
+                    'Bleu_4': Bleu(),
+                    'CIDEr': CiderD(df=opt.train_cached_tokens),
+                    'METEOR': Meteor(),
+                    'ROUGE_L': Rouge()
+                }[opt.eval_metric]
+
+                #logger.info('loading gt refs: %s', train_loader.cocofmt_file)
+                #gt_refs = utils.load_gt_refs(train_loader.cocofmt_file)
+
+            mixer_from = opt.mixer_from
+            if opt.use_mixer == 1 and rl_training:
+                #annealing_mixer = opt.ss_k / \
+                #    (opt.ss_k + np.exp((infos['epoch'] - opt.use_rl_after) / opt.ss_k))
+                #annealing_mixer = int(round(annealing_mixer * opt.seq_length))
+
+                # -1 for annealing
+                if opt.mixer_from == -1:
+                    annealing_mixer = opt.seq_length - int(
+                        np.ceil((infos['epoch'] - opt.use_rl_after + 1) /
+                                opt.mixer_descrease_every))
+                    mixer_from = max(1, annealing_mixer)
+
+                model.set_mixer_from(mixer_from)
+
+            scb_captions = opt.scb_captions
+            if opt.use_cst == 1 and rl_training:
+                # if opt.use_cst == 1 and opt.ss_k == 0,
+                # then do not using annealing, but the fixed scb_captions provided
+                #annealing_robust = opt.ss_k / \
+                #    (opt.ss_k + np.exp((infos['epoch'] - opt.use_rl_after) / opt.ss_k))
+                #annealing_robust = int(round((1 - annealing_robust) * seq_per_img))
+
+                # do not use robust before fully mixed
+                # if opt.use_mixer == 1 and mixer_from > 1:
+                #    opt.use_cst_after = infos['epoch']
+
+                # if opt.scb_captions is -1, then use the annealing value,
+                # otherwise, use the set value
+                if opt.scb_captions == -1:
+                    annealing_robust = int(
+                        np.ceil((infos['epoch'] - opt.use_cst_after + 1) /
+                                opt.cst_increase_every))
+                    scb_captions = min(annealing_robust, seq_per_img - 1)
+
+            optimizer.zero_grad()
+            model.set_seq_per_img(seq_per_img)
 
-        loss.backward()
-        clip_grad_norm_(model.parameters(), opt.grad_clip)
-        optimizer.step()
-        infos['TrainLoss'] = loss.item()
-        infos['mixer_from'] = mixer_from
-        infos['scb_captions'] = scb_captions
+            if rl_training:
+                # sampling from model distribution
+                # model_res, logprobs = model.sample(
+                #    feats, {'sample_max': 0, 'expand_feat': opt.expand_feat, 'temperature': 1})
+
+                # using mixer
+                pred, model_res, logprobs = model(feats, labels)
+
+                if opt.use_cst == 0:
+                    # greedy decoding baseline in SCST paper
+                    greedy_baseline, _ = model.sample(feats, {
+                        'sample_max': 1,
+                        'expand_feat': opt.expand_feat
+                    })
+
+                if opt.use_cst == 1:
+                    bcmrscores = data['bcmrscores']
+                    reward, m_score, g_score = utils.get_cst_reward(
+                        model_res.cpu().numpy(),
+                        data['gts'],
+                        bcmr_scorer,
+                        bcmrscores=bcmrscores,
+                        expand_feat=opt.expand_feat,
+                        seq_per_img=train_loader.get_seq_per_img(),
+                        scb_captions=scb_captions,
+                        scb_baseline=opt.scb_baseline,
+                        use_eos=opt.use_eos,
+                        use_mixer=opt.use_mixer)
+                else:
+                    # use greedy baseline by default, compute self-critical reward
+                    reward, m_score, g_score = utils.get_self_critical_reward(
+                        model_res.cpu().numpy(),
+                        greedy_baseline.cpu().numpy(),
+                        data['gts'],
+                        bcmr_scorer,
+                        expand_feat=opt.expand_feat,
+                        seq_per_img=train_loader.get_seq_per_img(),
+                        use_eos=opt.use_eos)
+
+                loss = rl_criterion(
+                    model_res,
+                    logprobs,
+                    torch.from_numpy(reward).float().to(opt.device),
+                )
+
+            elif opt.fused_xe == 1:
+                loss = model.xe_loss(feats, labels, masks)
+            else:
+                pred = model(feats, labels)[0]
+                loss = criterion(pred, labels[:, 1:], masks[:, 1:])
 
-        if infos['iter'] % opt.print_log_interval == 0:
-            elapsed_time = time.time() - t_start
+            loss.backward()
+            clip_grad_norm_(model.parameters(), opt.grad_clip)
+            optimizer.step()
+            infos['TrainLoss'] = loss.item()
+            infos['mixer_from'] = mixer_from
+            infos['scb_captions'] = scb_captions
 
-            log_info = [('Epoch', infos['epoch']), ('Iter', infos['iter']),
-                        ('Loss', infos['TrainLoss'])]
+            if infos['iter'] % opt.print_log_interval == 0:
+                elapsed_time = time.time() - t_start
 
-            if rl_training:
-                log_info += [('Reward',
-                              np.mean(reward[:, 0])), ('{} (m)'.format(
-                                  opt.eval_metric), m_score), ('{} (b)'.format(
-                                      opt.eval_metric), g_score)]
+                log_info = [('Epoch', infos['epoch']), ('Iter', infos['iter']),
+                            ('Loss', infos['TrainLoss'])]
 
-            if opt.use_ss == 1:
-                log_info += [('ss_prob', opt.ss_prob)]
+                if rl_training:
+                    log_info += [('Reward',
+                                  np.mean(reward[:, 0])), ('{} (m)'.format(
+                                      opt.eval_metric), m_score), ('{} (b)'.format(
+                                          opt.eval_metric), g_score)]
 
-            if opt.use_mixer == 1:
-                log_info += [('mixer_from', mixer_from)]
+                if opt.use_ss == 1:
+                    log_info += [('ss_prob', opt.ss_prob)]
 
-            if opt.use_cst == 1:
-                log_info += [('scb_captions', scb_captions)]
+                if opt.use_mixer == 1:
+                    log_info += [('mixer_from', mixer_from)]
 
-            log_info += [('Time', elapsed_time)]
-            logger.info('%s', '\t'.join(
-                ['{}: {}'.format(k, v) for (k, v) in log_info]))
+                if opt.use_cst == 1:
+                    log_info += [('scb_captions', scb_captions)]
 
-        infos['iter'] += 1
+                log_info += [('AvgSteps', train_loader.get_avg_steps())]
+                log_info += [('Time', elapsed_time)]
+                logger.info('%s', '\t'.join(
+                    ['{}: {}'.format(k, v) for (k, v) in log_info]))
+                log_io_stats(train_loader)
 
-        if infos['epoch'] < train_loader.get_current_epoch():
-            infos['epoch'] = train_loader.get_current_epoch()
-            checkpoint_checked = False
-            learning_rate = utils.adjust_learning_rate(
-                opt, optimizer, infos['epoch'] - infos['start_epoch'])
-            logger.info('===> Learning rate: %f: ', learning_rate)
+            infos['iter'] += 1
 
-        if (infos['epoch'] >= opt.save_checkpoint_from and
-                infos['epoch'] % opt.save_checkpoint_every == 0 and
-                not checkpoint_checked):
-            # evaluate the validation performance
-            results = validate(model, criterion, val_loader, opt)
-            logger.info('Validation output: %s',
-                        json.dumps(results['scores'], indent=4, sort_keys=True))
-            infos.update(results['scores'])
+            if infos['epoch'] < train_loader.get_current_epoch():
+                infos['epoch'] = train_loader.get_current_epoch()
+                checkpoint_checked = False
+                learning_rate = utils.adjust_learning_rate(
+                    opt, optimizer, infos['epoch'] - infos['start_epoch'])
+                logger.info('===> Learning rate: %f: ', learning_rate)
 
-            check_model(model, opt, infos, infos_history)
-            checkpoint_checked = True
+            if (infos['epoch'] >= opt.save_checkpoint_from and
+                    infos['epoch'] % opt.save_checkpoint_every == 0 and
+                    not checkpoint_checked):
+                run_validation()
 
-        if (infos['epoch'] >= opt.max_epochs or
-                infos['epoch'] - infos['best_epoch'] > opt.max_patience):
-            logger.info('>>> Terminating...')
-            break
+            check_signals()
+            stop = finished()
+
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
 
     return infos
 
 
-def validate(model, criterion, loader, opt):
+def validate(model, criterion, loader, opt, check_signals=None):
+    """Loss and captions of the videos of loader, check_signals is called
+    before each batch (see train)
+    """
 
     model.eval()
     loader.reset()
@@ -282,7 +466,6 @@ def validate(model, criterion, loader, opt):
     num_videos = loader.get_num_videos()
     batch_size = loader.get_batch_size()
     num_iters = int(np.ceil(num_videos / batch_size))
-    last_batch_size = num_videos % batch_size
     seq_per_img = loader.get_seq_per_img()
     model.set_seq_per_img(seq_per_img)
 
@@ -292,42 +475,40 @@ def validate(model, criterion, loader, opt):
     predictions = []
     gt_avglogps = []
     test_avglogps = []
+    # time spent in the model (with the copies to the device)
+    model_time = 0
+    start = time.time()
     for ii in range(num_iters):
+        if check_signals is not None:
+            check_signals()
+        # the last batch only has the remaining videos (exact_final_batch)
         data = loader.get_batch()
-        feats = data['feats']
-        if loader.has_label:
-            labels = data['labels']
-            masks = data['masks']
-
-        if ii == (num_iters - 1) and last_batch_size > 0:
-            feats = [f[:last_batch_size] for f in feats]
-            if loader.has_label:
-                labels = labels[:last_batch_size *
-                                seq_per_img]  # labels shape is DxN
-                masks = masks[:last_batch_size * seq_per_img]
-
-        feats = [feat.cuda() for feat in feats]
+        t_start = time.time()
+        feats = feats_to_device(data['feats'], opt.device)
         if loader.has_label:
-            labels = labels.cuda()
-            masks = masks.cuda()
+            labels = data['labels'].to(opt.device)
+            masks = data['masks'].to(opt.device)
 
         if loader.has_label:
-            with torch.no_grad():
-                pred, gt_seq, gt_logseq = model(feats, labels)
-            gt_seq = gt_seq.cpu().numpy()
-            gt_logseq = gt_logseq.cpu().numpy()
-            if opt.output_logp == 1:
-                gt_avglogp = utils.compute_avglogp(gt_seq, gt_logseq)
-                gt_avglogps.extend(gt_avglogp)
-
-
-            loss = criterion(pred, labels[:, 1:], masks[:, 1:])
+            if opt.output_logp == 1 or opt.fused_xe == 0:
+                with torch.no_grad():
+                    pred, gt_seq, gt_logseq = model(feats, labels)
+                if opt.output_logp == 1:
+                    gt_avglogp = utils.compute_avglogp(gt_seq.cpu().numpy(),
+                                                       gt_logseq.cpu().numpy())
+                    gt_avglogps.extend(gt_avglogp)
+
+                loss = criterion(pred, labels[:, 1:], masks[:, 1:])
+            else:
+                with torch.no_grad():
+                    loss = model.xe_loss(feats, labels, masks)
             loss_sum += loss.item()
 
         with torch.no_grad():
             seq, logseq = model.sample(feats, {'beam_size': opt.beam_size})
         seq = seq.cpu().numpy()
         logseq = logseq.cpu().numpy()
+        model_time += time.time() - t_start
         sents = utils.decode_sequence(opt.vocab, seq)
         if opt.output_logp == 1:
             test_avglogp = utils.compute_avglogp(seq, logseq)
@@ -346,6 +527,27 @@ def validate(model, criterion, loader, opt):
             logger.debug('[%d] video %s: %s' % (jj, entry['image_id'],
                                                 entry['caption']))
 
+    total_time = time.time() - start
+    throughput = {
+        'device': str(opt.device),
+        'num_threads': torch.get_num_threads(),
+        'videos': num_videos,
+        'model_time': model_time,
+        'total_time': total_time,
+        'model_videos_per_sec': num_videos / max(model_time, 1e-6),
+        'videos_per_sec': num_videos / max(total_time, 1e-6)
+    }
+    logger.info(
+        'Throughput on %s (%d threads): %.1f videos/s in the model, %.1f videos/s overall (%d videos in %.1fs)',
+        throughput['device'], throughput['num_threads'],
+        throughput['model_videos_per_sec'], throughput['videos_per_sec'],
+        num_videos, total_time)
+
+    feat_cache_stats = loader.get_feat_cache_stats()
+    if feat_cache_stats is not None:
+        logger.info('Feature cache: %s', feat_cache_stats)
+    log_io_stats(loader)
+
     loss = round(loss_sum / num_iters, 3)
     results = {}
     lang_stats = {}
@@ -354,6 +556,7 @@ def validate(model, criterion, loader, opt):
         lang_stats = language_eval(predictions, loader.cocofmt_file, opt)
 
     results['predictions'] = predictions
+    results['throughput'] = throughput
     results['scores'] = {'Loss': -loss}
     results['scores'].update(lang_stats)
 
@@ -429,6 +632,8 @@ if __name__ == '__main__':
     logger.info('Input arguments: %s',
                 json.dumps(vars(opt), sort_keys=True, indent=4))
 
+    device = setup_device(opt)
+
     # Set the random seed manually for reproducibility.
     np.random.seed(opt.seed)
     torch.manual_seed(opt.seed)
@@ -443,9 +648,31 @@ if __name__ == '__main__':
         'eval_metric': opt.eval_metric,
         'seq_per_img': opt.train_seq_per_img,
         'num_chunks': opt.num_chunks,
+        'prefetch': opt.prefetch,
+        'bulk_read': opt.bulk_read,
+        'num_buffers': opt.num_buffers,
+        'share_buffers': opt.share_buffers,
+        'shm_cache': opt.shm_cache,
+        'chunk_cache_mb': opt.chunk_cache_mb,
+        'chunk_cache_slots': opt.chunk_cache_slots,
+        'chunk_cache_w0': opt.chunk_cache_w0,
+        'rank': opt.rank,
+        'world_size': opt.world_size,
+        'seed': opt.seed,
+        'length_bucketing': opt.length_bucketing,
+        'block_size': opt.block_size,
+        'block_window': opt.block_window,
         'mode': 'train'
     }
 
+    if len(opt.train_label_h5) > 1:
+        train_opt['mixture_weights'] = opt.mixture_weights
+        train_opt['vocab_json'] = opt.mixture_vocab
+    else:
+        train_opt['label_h5'] = opt.train_label_h5[0]
+        if opt.train_bcmrscores_pkl is not None:
+            train_opt['bcmrscores_pkl'] = opt.train_bcmrscores_pkl[0]
+
     val_opt = {
         'label_h5': opt.val_label_h5,
         'batch_size': opt.test_batch_size,
@@ -453,6 +680,17 @@ if __name__ == '__main__':
         'cocofmt_file': opt.val_cocofmt_file,
         'seq_per_img': opt.test_seq_per_img,
         'num_chunks': opt.num_chunks,
+        'prefetch': opt.prefetch,
+        'bulk_read': opt.bulk_read,
+        'num_buffers': opt.num_buffers,
+        'share_buffers': opt.share_buffers,
+        'shm_cache': opt.shm_cache,
+        'chunk_cache_mb': opt.chunk_cache_mb,
+        'chunk_cache_slots': opt.chunk_cache_slots,
+        'chunk_cache_w0': opt.chunk_cache_w0,
+        'feat_cache_mb': opt.feat_cache_mb,
+        'exact_final_batch': 1,
+        'seed': opt.seed,
         'mode': 'test'
     }
 
@@ -463,10 +701,28 @@ if __name__ == '__main__':
         'cocofmt_file': opt.test_cocofmt_file,
         'seq_per_img': opt.test_seq_per_img,
         'num_chunks': opt.num_chunks,
+        'prefetch': opt.prefetch,
+        'bulk_read': opt.bulk_read,
+        'num_buffers': opt.num_buffers,
+        'share_buffers': opt.share_buffers,
+        'shm_cache': opt.shm_cache,
+        'chunk_cache_mb': opt.chunk_cache_mb,
+        'chunk_cache_slots': opt.chunk_cache_slots,
+        'chunk_cache_w0': opt.chunk_cache_w0,
+        'feat_cache_mb': opt.feat_cache_mb,
+        'exact_final_batch': 1,
+        'seed': opt.seed,
         'mode': 'test'
     }
 
-    train_loader = DataLoader(train_opt)
+    if len(opt.train_label_h5) > 1:
+        train_loader = MixtureLoader(train_opt)
+    else:
+        train_loader = DataLoader(train_opt)
+
+    # val/test labels are encoded with the vocabulary of the model
+    val_opt['vocab'] = train_loader.vocab
+    test_opt['vocab'] = train_loader.vocab
     val_loader = DataLoader(val_opt)
     test_loader = DataLoader(test_opt)
 
@@ -475,6 +731,7 @@ if __name__ == '__main__':
     opt.seq_length = train_loader.get_seq_length()
     opt.feat_dims = train_loader.get_feat_dims()
     opt.history_file = opt.model_file.replace('.pth', '_history.json', 1)
+    opt.resume_file = opt.model_file.replace('.pth', '_resume.pth', 1)
 
     logger.info('Building model...')
     model = CaptionModel(opt)
@@ -482,9 +739,9 @@ if __name__ == '__main__':
     xe_criterion = CrossEntropyCriterion()
     rl_criterion = RewardCriterion()
 
-    model.cuda()
-    xe_criterion.cuda()
-    rl_criterion.cuda()
+    model.to(device)
+    xe_criterion.to(device)
+    rl_criterion.to(device)
 
     logger.info('Start training...')
     start = datetime.now()
@@ -509,7 +766,8 @@ if __name__ == '__main__':
         start = datetime.now()
 
         logger.info('Loading model: %s', opt.model_file)
-        checkpoint = torch.load(opt.model_file)
+        checkpoint = torch.load(
+            opt.model_file, map_location='cpu', weights_only=False)
         model.load_state_dict(checkpoint['model'])
 
         test(model, xe_criterion, test_loader, opt)